@@ -26,6 +26,8 @@ CREATE TABLE reserved (
 	timestamp FLOAT NOT NULL
 );
 
+CREATE INDEX reserved_latest ON reserved (username, type, timestamp);
+
 CREATE TABLE triggers (
 	username VARCHAR(20) NOT NULL references users(username)
 	ON DELETE CASCADE ON UPDATE CASCADE,
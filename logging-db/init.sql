@@ -14,7 +14,8 @@ CREATE TABLE usercommands (
 	username VARCHAR(20),
 	stock_symbol VARCHAR(3),
 	filename VARCHAR(20),
-	funds FLOAT
+	funds FLOAT,
+	id BIGSERIAL
 );
 
 CREATE TABLE quoteservers (
@@ -25,7 +26,8 @@ CREATE TABLE quoteservers (
 	stock_symbol VARCHAR(3) NOT NULL,
 	username VARCHAR(20) NOT NULL,
 	quote_server_time BIGINT NOT NULL,
-	crypto_key VARCHAR(80) NOT NULL
+	crypto_key VARCHAR(80) NOT NULL,
+	id BIGSERIAL
 );
 
 CREATE TABLE accounttransactions (
@@ -34,7 +36,8 @@ CREATE TABLE accounttransactions (
 	transaction_num INTEGER NOT NULL,
 	action VARCHAR(6) NOT NULL,
 	username VARCHAR(20) NOT NULL,
-	funds FLOAT
+	funds FLOAT,
+	id BIGSERIAL
 );
 
 CREATE TABLE systemevents (
@@ -7,6 +7,8 @@ import threading
 
 logger = logging.getLogger(__name__)
 
+FLUSH_INTERVAL = 1 # Seconds between flushes of buffered log rows.
+
 class Consumer(object):
     def __init__(self):
         credentials = pika.credentials.PlainCredentials('admin','admin')
@@ -36,6 +38,11 @@ class Consumer(object):
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue='logs')
         self.channel.basic_consume(consumer_callback=self.callback, queue='logs', no_ack=True)
+
+        # The database buffers rows until it has enough of them, so make sure
+        # that they are written out in a timely manner when traffic is low.
+        # This runs on the consumer thread, so it never races the callback.
+        self.connection.add_timeout(FLUSH_INTERVAL, self.flush)
         consumer_thread = threading.Thread(target=self.consume)
         consumer_thread.start()
         logger.debug("Finished init of Consumer")
@@ -43,6 +50,16 @@ class Consumer(object):
     def callback(self, ch, method, properties, body):
         logger.info("Consumed %s",body)
         j = json.loads(body)
+
+        # Publishers batch their events into a single JSON array, but a
+        # lone event is still accepted.
+        if isinstance(j, list):
+            for event in j:
+                self.handle(event)
+        else:
+            self.handle(j)
+
+    def handle(self, j):
         log_type = j["type"]
         data = j["data"]
         if log_type == "userCommand":
@@ -60,6 +77,13 @@ class Consumer(object):
         else:
             logger.error("MESSAGE TYPE NOT FOUND %s",log_type)
     
+    def flush(self):
+        try:
+            self.db.flush()
+        except:
+            logger.exception("Periodic flush of log rows failed.")
+        self.connection.add_timeout(FLUSH_INTERVAL, self.flush)
+
     def consume(self):
         self.channel.start_consuming()  
 
@@ -1,9 +1,24 @@
 import psycopg2
+import psycopg2.extras
 import logging
+import heapq
 from lib.xml_writer import *
 
 logger = logging.getLogger(__name__)
 
+FLUSH_SIZE = 1000 # Number of buffered rows that forces a flush.
+ITERSIZE = 2000 # Number of rows fetched at a time while streaming a DUMPLOG.
+
+# The columns of each table, in the order that rows are buffered.
+COLUMNS = {
+    "usercommands": "timestamp, server, transaction_num, command, username, stock_symbol, filename, funds",
+    "quoteservers": "timestamp, server, transaction_num, price, stock_symbol, username, quote_server_time, crypto_key",
+    "accounttransactions": "timestamp, server, transaction_num, action, username, funds",
+    "systemevents": "timestamp, server, transaction_num, command, username, stock_symbol, filename, funds",
+    "errorevents": "timestamp, server, transaction_num, command, username, stock_symbol, filename, funds, error_message",
+    "debugevents": "timestamp, server, transaction_num, command, username, stock_symbol, filename, funds, debug_message"
+}
+
 class logging_DB(object):
     def __init__(self):
         """ Connect to the PostgreSQL database server """
@@ -15,6 +30,54 @@ class logging_DB(object):
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(error)
 
+        # Rows are buffered per table and inserted in bulk, rather
+        # than paying for a round trip and commit on every event.
+        self.buffered = {table: [] for table in COLUMNS}
+        self.pending = 0
+
+    def buffer(self, table, row):
+        self.buffered[table].append(row)
+        self.pending += 1
+        if self.pending >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Insert all buffered rows, and commit them in a single transaction """
+        if not self.pending:
+            return
+
+        cur = self.conn.cursor()
+        try:
+            for table, rows in self.buffered.items():
+                if rows:
+                    sql = f"""INSERT INTO {table} ({COLUMNS[table]}) VALUES %s"""
+                    psycopg2.extras.execute_values(cur, sql, rows, page_size=FLUSH_SIZE)
+            self.conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            # A single bad row fails the entire batch, so fall back to
+            # inserting one row at a time to only lose the bad rows.
+            logger.error("Bulk insert failed, inserting individually: %s", error)
+            self.conn.rollback()
+            self._insert_individually(cur)
+        finally:
+            cur.close()
+
+        for rows in self.buffered.values():
+            rows.clear()
+        self.pending = 0
+
+    def _insert_individually(self, cur):
+        for table, rows in self.buffered.items():
+            for row in rows:
+                placeholders = ",".join(["%s"] * len(row))
+                sql = f"""INSERT INTO {table} ({COLUMNS[table]}) VALUES ({placeholders})"""
+                try:
+                    cur.execute(sql, row)
+                    self.conn.commit()
+                except (Exception, psycopg2.DatabaseError) as error:
+                    logger.error("Dropping row %s for %s: %s", row, table, error)
+                    self.conn.rollback()
+
     def disconnect(self):
         self.conn.close()
 
@@ -32,14 +95,11 @@ class logging_DB(object):
             filename = data["filename"]
         if "funds" in data:
             funds = data["funds"]
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO usercommands (timestamp, server, transaction_num, command, username, stock_symbol, filename, funds)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds))
-        self.conn.commit()
-        cur.close()
+        self.buffer("usercommands", (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds))
         # check if the command is a DUMPLOG
         if command == "DUMPLOG":
+            # Everything logged up to this point must be in the dump.
+            self.flush()
             self.dumplog(filename,username)
         
     def quoteServer(self,data):
@@ -52,12 +112,7 @@ class logging_DB(object):
         quote_server_time = data["quote_server_time"]
         crypto_key = data["crypto_key"]
 
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO quoteservers (timestamp, server, transaction_num, price, stock_symbol, username, quote_server_time, crypto_key)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,price,stock_symbol,username,quote_server_time,crypto_key))
-        self.conn.commit()
-        cur.close()
+        self.buffer("quoteservers", (timestamp,server,transaction_num,price,stock_symbol,username,quote_server_time,crypto_key))
 
     def accountTransaction(self,data):
         timestamp = data["timestamp"]
@@ -69,12 +124,7 @@ class logging_DB(object):
         if "funds" in data:
             funds = data["funds"]
 
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO accounttransactions (timestamp, server, transaction_num, action, username, funds)
-                    VALUES (%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,action,username,funds))
-        self.conn.commit()
-        cur.close()
+        self.buffer("accounttransactions", (timestamp,server,transaction_num,action,username,funds))
 
     def systemEvent(self,data):
         timestamp = data["timestamp"]
@@ -91,12 +141,7 @@ class logging_DB(object):
         if "funds" in data:
             funds = data["funds"]
 
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO systemevents (timestamp, server, transaction_num, command, username, stock_symbol, filename, funds)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds))
-        self.conn.commit()
-        cur.close()
+        self.buffer("systemevents", (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds))
         
     def errorEvent(self,data):
         timestamp = data["timestamp"]
@@ -115,19 +160,14 @@ class logging_DB(object):
         if "error_message" in data:
             error_message = data["error_message"]
 
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO errorevents (timestamp, server, transaction_num, command, username, stock_symbol, filename, funds, error_message)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds,error_message))
-        self.conn.commit()
-        cur.close()
+        self.buffer("errorevents", (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds,error_message))
 
     def debugEvent(self,data):
         timestamp = data["timestamp"]
         server = data["server"]
         transaction_num = data["transaction_num"]
         command = data["command"]
-        username = stock_symbol = funds = debug_message = None
+        username = stock_symbol = filename = funds = debug_message = None
         if "username" in data:
             username = data["username"]
         if "stock_symbol" in data:
@@ -139,60 +179,47 @@ class logging_DB(object):
         if "debug_message" in data:
             debug_message = data["debug_message"]
 
-        cur = self.conn.cursor()
-        sql = f"""INSERT INTO debugevents (timestamp, server, transaction_num, command, username, stock_symbol, filename, funds, debug_message)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) """
-        cur.execute(sql, (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds,debug_message))
-        self.conn.commit()
-        cur.close()
+        self.buffer("debugevents", (timestamp,server,transaction_num,command,username,stock_symbol,filename,funds,debug_message))
     
-    def dumplog(self,filename,username=None):
-        cur = self.conn.cursor()
-        usercommands = quotes = accounttransactions = []
+    def _stream(self, table, username, eventClass, columns):
+        """ Yield the events stored in a table in timestamp order, using a server side cursor """
+        # Named cursors are kept on the server, and only ITERSIZE
+        # rows are fetched into memory at any one time. Rows with the
+        # same timestamp are kept in the order that they were logged.
+        cur = self.conn.cursor(name=f"dumplog_{table}")
+        cur.itersize = ITERSIZE
         if username is None:
-            cur.execute("""SELECT * FROM usercommands""")
-            usercommands = cur.fetchall()
-            cur.execute("""SELECT * FROM accounttransactions""")
-            accounttransactions = cur.fetchall()
-            cur.execute("""SELECT * FROM quoteservers""")
-            quotes = cur.fetchall()
-            cur.close()
+            cur.execute(f"""SELECT {COLUMNS[table]} FROM {table} ORDER BY timestamp, id""")
         else:
-            cur.execute("""SELECT * FROM usercommands WHERE username = %s """, (username,))
-            usercommands = cur.fetchall()
-            cur.execute("""SELECT * FROM accounttransactions WHERE username = %s""", (username,))
-            accounttransactions = cur.fetchall()
-            cur.execute("""SELECT * FROM quoteservers WHERE username = %s""", (username,))
-            quotes = cur.fetchall()
-            cur.close()
-        combined = usercommands + accounttransactions + quotes
-        sorted_combined = sorted(combined, key=lambda x: x[0])
+            cur.execute(f"""SELECT {COLUMNS[table]} FROM {table} WHERE username = %s ORDER BY timestamp, id""", (username,))
+
+        for row in cur:
+            yield row[0], eventClass, columns, row
+        cur.close()
+
+    def _toEvent(self, item):
+        timestamp, eventClass, columns, row = item
+        # Rows are stored as they were received, so they are validated here.
+        return eventClass.fromValues(columns, row)
+
+    def dumplog(self,filename,username=None):
+        usercommands = self._stream("usercommands", username, UserCommand,
+                "timestamp server transactionNum command username stockSymbol filename funds".split(" "))
+        accounttransactions = self._stream("accounttransactions", username, AccountTransaction,
+                "timestamp server transactionNum action username funds".split(" "))
+        quotes = self._stream("quoteservers", username, QuoteServer,
+                "timestamp server transactionNum price stockSymbol username quoteServerTime cryptokey".split(" "))
+
+        # Each table is already sorted, so a k-way merge on the timestamp
+        # gives the combined ordering without loading every row at once.
+        # Ties are taken from the tables in the order that they are given.
+        combined = heapq.merge(usercommands, accounttransactions, quotes, key=lambda item: item[0])
+        events = map(self._toEvent, combined)
+
         log_path = str("/out/"+filename)
         builder = LogBuilder()
-        for row in sorted_combined:
-            if len(row) == 8: # user command or quote
-                if isinstance(row[6],int):
-                    columns = "timestamp server transactionNum price stockSymbol username quoteServerTime cryptokey".split(" ")
-                    event = QuoteServer()
-                    for idx,col in enumerate(row):
-                        if col is not None:
-                            event.update(columns[idx],col)
-                    builder.store(event)
-                else:   
-                    columns = "timestamp server transactionNum command username stockSymbol filename funds".split(" ")
-                    event = UserCommand()
-                    for idx,col in enumerate(row):
-                        if col is not None:
-                            event.update(columns[idx],col)
-                    builder.store(event)
-            elif len(row) == 6: # account transaction
-                columns = "timestamp server transactionNum action username funds".split(" ")
-                event = AccountTransaction()
-                for idx,col in enumerate(row):
-                    if col is not None:
-                        event.update(columns[idx],col)
-                builder.store(event)
-        builder.write(log_path)
-
-            
-        
+        try:
+            builder.writeStream(log_path, events)
+        finally:
+            # Ends the transaction, which closes any cursors left open.
+            self.conn.commit()
@@ -1,8 +1,9 @@
 import os
+import re
+import uuid
 from threading import Thread
 from queue import Queue
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 
 """
 VERIFICATION FUNCTION DEFINITIONS
@@ -28,30 +29,58 @@ def _isStockSymbol(candidate):
         return True
     return False
 
+_COMMANDS = frozenset([
+        "ADD",
+        "QUOTE",
+        "BUY",
+        "COMMIT_BUY",
+        "CANCEL_BUY",
+        "SELL",
+        "COMMIT_SELL",
+        "CANCEL_SELL",
+        "SET_BUY_AMOUNT",
+        "CANCEL_SET_BUY",
+        "SET_BUY_TRIGGER",
+        "SET_SELL_AMOUNT",
+        "SET_SELL_TRIGGER",
+        "CANCEL_SET_SELL",
+        "DUMPLOG",
+        "DISPLAY_SUMMARY"
+])
+
 def _isCommand(candidate):
-    valid = [
-            "ADD",
-            "QUOTE",
-            "BUY",
-            "COMMIT_BUY",
-            "CANCEL_BUY",
-            "SELL",
-            "COMMIT_SELL",
-            "CANCEL_SELL",
-            "SET_BUY_AMOUNT",
-            "CANCEL_SET_BUY",
-            "SET_BUY_TRIGGER",
-            "SET_SELL_AMOUNT",
-            "SET_SELL_TRIGGER",
-            "CANCEL_SET_SELL",
-            "DUMPLOG",
-            "DISPLAY_SUMMARY"
-    ]
     if (isinstance(candidate, str)
-            and candidate in valid):
+            and candidate in _COMMANDS):
         return True
     return False
 
+def _isString(candidate):
+    return isinstance(candidate, str)
+
+def _isFloat(candidate):
+    return isinstance(candidate, float)
+
+def _isInt(candidate):
+    return isinstance(candidate, int)
+
+
+"""
+SERIALIZATION HELPERS
+"""
+
+INDENT = "   "
+
+_ESCAPED = re.compile(r'[&<>"\r]')
+
+def _escape(text):
+    # Matches the escaping (and line ending normalization) that the text
+    # would go through on a round trip through ElementTree and minidom.
+    if not _ESCAPED.search(text):
+        return text
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("&", "&amp;").replace("<", "&lt;")
+    return text.replace("\"", "&quot;").replace(">", "&gt;")
+
 
 """
 CLASS DEFINITIONS
@@ -61,28 +90,68 @@ CLASS DEFINITIONS
 Represents the baseclass for all log events. Field members should not be accessed directly, and
 all modifications to attributes should be done through the provided functions. Accessors with 
 a prepended '_' symbol should be considered private.
+
+Derivations define their XML tag in '_tag', and the attributes they support in '_supportedTypes',
+a dictionary of form - "key": (verification_function, is_a_mandatory_field). Both are shared by
+every instance of the class, so an event only holds its own attribute values.
 """
 class _LogEvent:
 
+    __slots__ = ("_attributes",)
+
+    _tag = None
+    _supportedTypes = {
+            "timestamp": (_isTimestamp, True), 
+            "server": (_isString, True),
+            "transactionNum": (_isPositiveInt, True)
+    }
+    _mandatory = ("timestamp", "server", "transactionNum")
+
     """
-    Initialize the event.
+    Build the attribute types for a derivation, which always include those of the baseclass.
 
-    tag:            a string representing the tag type used in the XML
-    supportedTypes: a dictionary of form - "key": (verification_function, is_a_mandatory_field)
+    **supportedTypes: the additional types, in the form of the '_supportedTypes' dictionary
     """
-    def __init__(self, tag, **supportedTypes):
-        self._tag = tag
+    @staticmethod
+    def _schema(**supportedTypes):
+        schema = dict(_LogEvent._supportedTypes)
+        schema.update(supportedTypes)
+        return schema
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
 
+        # Computed once per class rather than on every mandatory check.
+        cls._mandatory = tuple(key for key, value in cls._supportedTypes.items() if value[1])
+
+    """
+    Initialize the event.
+
+    **args: the initial attributes, in the same form as #updateAll(**args)
+    throws: ValueError if one of the provided key/value pairs is invalid
+    """
+    def __init__(self, **args):
         self._attributes = dict()
-        self._supportedTypes = {
-                "timestamp": (lambda x: _isTimestamp(x), True), 
-                "server": (lambda x: isinstance(x, str), True),
-                "transactionNum": (lambda x: _isPositiveInt(x), True)
-        }
-        self._supportedTypes.update(supportedTypes)
+        self.updateAll(**args)
 
     """
-    Update the current set of attributes with new values or new attributes.
+    Create an event from parallel sequences of keys and values, skipping any None values. This is
+    intended for rows read back from the database.
+
+    keys:   the attribute keys
+    values: the value for each of the keys, or None if the attribute is not set
+    throws: ValueError if one of the provided key/value pairs is invalid
+    """
+    @classmethod
+    def fromValues(cls, keys, values):
+        event = cls.__new__(cls)
+        event._attributes = dict()
+        event.updateAll(**{key: value for key, value in zip(keys, values) if value is not None})
+        return event
+
+    """
+    Update the current set of attributes with new values or new attributes. The attributes are
+    only updated if every one of the provided key/value pairs is valid.
 
     **args: an unpacked list of key/value pairs to addform `updateAll(key1=value1, key2=value2)'
             or in the form `updateAll(**{key1: value1, key2: value2})' where the '**' indicates
@@ -90,18 +159,18 @@ class _LogEvent:
     throws: ValueError if one of the provided key/value pairs is invalid
     """
     def updateAll(self, **args):
-        validKeys = self._supportedTypes.keys()
+        supportedTypes = self._supportedTypes
         for key, value in args.items():
 
-            if key not in validKeys:
+            attributeTuple = supportedTypes.get(key)
+            if not attributeTuple:
                 raise ValueError("Key '{}' is not valid for this event type '{}'.".format(key, self._tag))
 
-            attributeTuple = self._supportedTypes[key]
             validationFunction = attributeTuple[0]
             if not validationFunction(value):
                 raise ValueError("Value '{}' is not a valid '{}'.".format(value, key))
 
-            self._attributes[key] = value
+        self._attributes.update(args)
 
     """
     Update or create a specific key/value pair of attributes.
@@ -116,15 +185,26 @@ class _LogEvent:
     """
     INTERNAL - don't use
 
+    Ensure that all of the mandatory attributes have been assigned.
+    throws: ValueError if one of the mandatory attributes is not assigned
+    """
+    def _checkMandatory(self):
+        remaining = [key for key in self._mandatory if key not in self._attributes]
+
+        if remaining:
+            keyword = "element" if len(remaining) == 1 else "elements"
+            raise ValueError("Mandatory {} {} not provided.".format(keyword, remaining))
+
+    """
+    INTERNAL - don't use
+
     Get an ET.Element that represents this object.
     throws: ValueError if one of the mandatory attributes is not assigned
     """
     def _getElement(self):
-        root = ET.Element(self._tag)
+        self._checkMandatory()
 
-        # Look for all mandatory attributes and store them for processing.
-        remaining = [key for key, value in self._supportedTypes.items() if value[1]]
-        
+        root = ET.Element(self._tag)
         for key, value in self._attributes.items():
             elem = ET.SubElement(root, key)
 
@@ -134,15 +214,41 @@ class _LogEvent:
             else:
                 elem.text = str(value)
 
-            # 'remaining' should be empty when all attributes accessed.
-            if key in remaining:
-                remaining.remove(key)
+        return root
 
-        if remaining:
-            keyword = "element" if len(remaining) == 1 else "elements"
-            raise ValueError("Mandatory {} {} not provided.".format(keyword, remaining))
+    """
+    INTERNAL - don't use
 
-        return root
+    Get the XML text for this object, identical to what pretty printing the result of
+    #_getElement() with minidom would give, but without building either tree.
+
+    indent: the indentation of the opening and closing tags
+    throws: ValueError if one of the mandatory attributes is not assigned
+    """
+    def _toXML(self, indent=""):
+        self._checkMandatory()
+
+        tag = self._tag
+        if not self._attributes:
+            return indent + "<" + tag + "/>\n"
+
+        child = indent + INDENT + "<"
+        parts = [indent, "<", tag, ">\n"]
+        for key, value in self._attributes.items():
+
+            if isinstance(value, float):
+                # Format to 2 decimal places.
+                text = "{0:.2f}".format(value)
+            else:
+                text = _escape(str(value))
+
+            if text:
+                parts += (child, key, ">", text, "</", key, ">\n")
+            else:
+                parts += (child, key, "/>\n")
+
+        parts += (indent, "</", tag, ">\n")
+        return "".join(parts)
 
 """
 From requirements:
@@ -151,17 +257,16 @@ From requirements:
 """
 class UserCommand(_LogEvent):
 
-    _supportedTypes = {
-            "command": (lambda x: _isCommand(x), True), 
-            "username": (lambda x: isinstance(x, str), False),
-            "stockSymbol": (lambda x: _isStockSymbol(x), False),
-            "filename": (lambda x: isinstance(x, str), False),
-            "funds": (lambda x: isinstance(x, float), False)
-    }
+    __slots__ = ()
 
-    def __init__(self, **args):
-        _LogEvent.__init__(self, "userCommand", **self._supportedTypes)
-        self.updateAll(**args)
+    _tag = "userCommand"
+    _supportedTypes = _LogEvent._schema(
+            command=(_isCommand, True), 
+            username=(_isString, False),
+            stockSymbol=(_isStockSymbol, False),
+            filename=(_isString, False),
+            funds=(_isFloat, False)
+    )
 
 """
 From requirements:
@@ -170,17 +275,16 @@ From requirements:
 """
 class QuoteServer(_LogEvent):
 
-    _supportedTypes = {
-            "price": (lambda x: isinstance(x, float), True), 
-            "username": (lambda x: isinstance(x, str), True),
-            "stockSymbol": (lambda x: _isStockSymbol(x), True),
-            "quoteServerTime": (lambda x: isinstance(x, int), True),
-            "cryptokey": (lambda x: isinstance(x, str), True)
-    }
+    __slots__ = ()
 
-    def __init__(self, **args):
-        _LogEvent.__init__(self, "quoteServer", **self._supportedTypes)
-        self.updateAll(**args)
+    _tag = "quoteServer"
+    _supportedTypes = _LogEvent._schema(
+            price=(_isFloat, True), 
+            username=(_isString, True),
+            stockSymbol=(_isStockSymbol, True),
+            quoteServerTime=(_isInt, True),
+            cryptokey=(_isString, True)
+    )
 
 """
 From requirements:
@@ -189,15 +293,14 @@ From requirements:
 """
 class AccountTransaction(_LogEvent):
 
-    _supportedTypes = {
-            "action": (lambda x: isinstance(x, str), True), 
-            "username": (lambda x: isinstance(x, str), True),
-            "funds": (lambda x: isinstance(x, float), True),
-    }
+    __slots__ = ()
 
-    def __init__(self, **args):
-        _LogEvent.__init__(self, "accountTransaction", **self._supportedTypes)
-        self.updateAll(**args)
+    _tag = "accountTransaction"
+    _supportedTypes = _LogEvent._schema(
+            action=(_isString, True), 
+            username=(_isString, True),
+            funds=(_isFloat, True)
+    )
 
 """
 From requirements:
@@ -206,17 +309,16 @@ From requirements:
 """
 class SystemEvent(_LogEvent):
 
-    _supportedTypes = {
-            "command": (lambda x: _isCommand(x), True), 
-            "username": (lambda x: isinstance(x, str), False),
-            "stockSymbol": (lambda x: _isStockSymbol(x), False),
-            "filename": (lambda x: isinstance(x, str), False),
-            "funds": (lambda x: isinstance(x, float), False),
-    }
+    __slots__ = ()
 
-    def __init__(self, **args):
-        _LogEvent.__init__(self, "systemEvent", **self._supportedTypes)
-        self.updateAll(**args)
+    _tag = "systemEvent"
+    _supportedTypes = _LogEvent._schema(
+            command=(_isCommand, True), 
+            username=(_isString, False),
+            stockSymbol=(_isStockSymbol, False),
+            filename=(_isString, False),
+            funds=(_isFloat, False)
+    )
 
 """
 From requirements:
@@ -225,10 +327,10 @@ From requirements:
 """
 class ErrorEvent(SystemEvent):
 
-    def __init__(self, **args):
-        typeDef = (lambda x: isinstance(x, str), False)
-        _LogEvent.__init__(self, "errorEvent", **self._supportedTypes, errorMessage=typeDef)
-        self.updateAll(**args)
+    __slots__ = ()
+
+    _tag = "errorEvent"
+    _supportedTypes = dict(SystemEvent._supportedTypes, errorMessage=(_isString, False))
 
 """
 From requirements:
@@ -237,10 +339,10 @@ From requirements:
 """
 class DebugEvent(SystemEvent):
 
-    def __init__(self, **args):
-        typeDef = (lambda x: isinstance(x, str), False)
-        _LogEvent.__init__(self, "debugEvent", **self._supportedTypes, debugMessage=typeDef)
-        self.updateAll(**args)
+    __slots__ = ()
+
+    _tag = "debugEvent"
+    _supportedTypes = dict(SystemEvent._supportedTypes, debugMessage=(_isString, False))
 
 """
 Represents a builder that can construct and write a log file. Derivations of the _LogEvent
@@ -295,13 +397,7 @@ class LogBuilder:
         if not self.appendEnabled:
             raise ValueError("Append mode is not configured.")
 
-        element = event._getElement()
-
-        raw = ET.tostring(element)
-        parsed = minidom.parseString(raw)
-        pretty = parsed.toprettyxml(indent="   ")
-        to_remove = pretty.find("\n") + 1 # Strip of version info line
-        final = pretty[to_remove:-1]
+        final = event._toXML()[:-1] # Strip the trailing new line
 
         LogBuilder.queue.put(final)
 
@@ -312,8 +408,10 @@ class LogBuilder:
     throws: ValueError if one of the mandatory attributes is not assigned
     """
     def store(self, event):
-        element = event._getElement()
-        self._elements.append(element)
+        # Events are serialized immediately, as the text is far smaller than the
+        # event itself, and later changes to the event should not be written.
+        username = event._attributes.get("username")
+        self._elements.append((username, event._toXML(INDENT)))
 
     """
     Write all of the constructed data to a file.
@@ -331,26 +429,61 @@ class LogBuilder:
     """
     def writeFiltered(self, filePath, username):
 
-        root = ET.Element("log")
-        for element in self._elements:
-            
-            if self.shouldExclude(element, username):
-                continue
-                
-            root.append(element)
+        with open(filePath, "w") as f:
+            f.write('<?xml version="1.0" ?>\n')
 
-        rawOutput = ET.tostring(root)
-        parsed = minidom.parseString(rawOutput)
-        pretty = parsed.toprettyxml(indent="   ")
+            empty = True
+            for element in self._elements:
 
-        with open(filePath, "w") as f:
-                f.write(pretty)
+                if self.shouldExclude(element, username):
+                    continue
+
+                if empty:
+                    f.write("<log>\n")
+                    empty = False
+
+                f.write(element[1])
+
+            f.write("<log/>\n" if empty else "</log>\n")
 
     """
-    Determine if a provided element should be excluded from the output based on
+    Write events to a file as they are produced, without holding them in memory. The output
+    is identical to that of #write(filePath) for the same events. It is written to a temporary
+    file beside filePath, which only replaces filePath once every event has been written, so
+    an event that fails validation leaves nothing half written behind.
+
+    filePath: the relative or absolute path that the logfile will be created as
+    events:   an iterable of derivations of the _LogEvent class
+    throws:   ValueError if one of the mandatory attributes is not assigned
+    """
+    def writeStream(self, filePath, events):
+
+        tempPath = "{}.{}.tmp".format(filePath, uuid.uuid4().hex)
+        try:
+            with open(tempPath, "w") as f:
+                f.write('<?xml version="1.0" ?>\n')
+
+                empty = True
+                for event in events:
+                    if empty:
+                        f.write("<log>\n")
+                        empty = False
+
+                    f.write(event._toXML(INDENT))
+
+                f.write("<log/>\n" if empty else "</log>\n")
+
+            os.replace(tempPath, filePath)
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+    """
+    Determine if a stored element should be excluded from the output based on
     the username that is being filtered on.
 
-    element:  the Element that may be either included or excluded
+    element:  the stored element that may be either included or excluded
     username: the username to filter by, or None to allow all usernames
     """
     def shouldExclude(self, element, username):
@@ -359,13 +492,8 @@ class LogBuilder:
         if not username:
             return False
 
-        children = list(element)
-
-        for child in children:
-            if child.tag == "username" and child.text == username:
-                return False
-
-        return True
+        elementUsername = element[0]
+        return elementUsername is None or str(elementUsername) != username
 
 
 
@@ -0,0 +1,108 @@
+"""
+Benchmark the direct XML serializer in lib/xml_writer.py against the previous
+ElementTree + minidom pretty printing path.
+
+The previous path built an ElementTree for every event, serialized it, parsed
+it again with minidom and pretty printed the result. Pretty printing an entire
+log through minidom at once needs several gigabytes for a million events, so
+the previous path is measured one event at a time, which is its best case.
+
+Events are drawn from a pool of POOL_SIZE distinct events, so that holding a
+million of them does not dominate the memory of the benchmark itself.
+
+Usage: python xml_benchmark.py [--events N]
+"""
+
+import argparse
+import io
+import itertools
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lib.xml_writer import *
+
+POOL_SIZE = 10000
+
+USERNAMES = ["oY01WVirLr", "9RCeWXbzj9", "user & <friend>", "quote\"d"]
+SYMBOLS = ["ABC", "S", "TGY", "XY"]
+COMMANDS = ["ADD", "BUY", "SELL", "COMMIT_BUY", "SET_BUY_TRIGGER", "DUMPLOG"]
+
+def build_events(count):
+    """Build a mix of every event type, with values that exercise escaping."""
+
+    events = []
+    for i in range(count):
+        common = {
+                "timestamp": 1546300800000 + i,
+                "server": "DDJK",
+                "transactionNum": i + 1
+        }
+        kind = i % 6
+        if kind == 0:
+            event = UserCommand(command=random.choice(COMMANDS), username=random.choice(USERNAMES),
+                    stockSymbol=random.choice(SYMBOLS), funds=random.uniform(0, 1000), **common)
+        elif kind == 1:
+            event = QuoteServer(price=random.uniform(0, 1000), username=random.choice(USERNAMES),
+                    stockSymbol=random.choice(SYMBOLS), quoteServerTime=1549827515 + i,
+                    cryptokey="crytoKEY=123=o", **common)
+        elif kind == 2:
+            event = AccountTransaction(action=random.choice(["add", "remove"]),
+                    username=random.choice(USERNAMES), funds=random.uniform(0, 1000), **common)
+        elif kind == 3:
+            event = SystemEvent(command=random.choice(COMMANDS), filename="./log\r\nfile.xml", **common)
+        elif kind == 4:
+            event = ErrorEvent(command=random.choice(COMMANDS), username=random.choice(USERNAMES),
+                    errorMessage="Funds insufficient to purchase requested stock.", **common)
+        else:
+            event = DebugEvent(command=random.choice(COMMANDS), debugMessage="", **common)
+        events.append(event)
+
+    return events
+
+def legacy(event, indent):
+    """The previous serialization path, for a single event."""
+
+    raw = ET.tostring(event._getElement())
+    parsed = minidom.parseString(raw)
+
+    pretty = io.StringIO()
+    parsed.documentElement.writexml(pretty, indent, "   ", "\n")
+    return pretty.getvalue()
+
+def direct(event, indent):
+    return event._toXML(indent)
+
+def measure(serialize, events, count, out):
+    start = time.perf_counter()
+    for event in itertools.islice(itertools.cycle(events), count):
+        out.write(serialize(event, "   "))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="XML serialization benchmark.")
+    parser.add_argument("--events", type=int, default=1000000)
+    args = parser.parse_args()
+
+    random.seed(468)
+    events = build_events(min(args.events, POOL_SIZE))
+
+    mismatches = sum(1 for event in events if legacy(event, "   ") != direct(event, "   "))
+    print("Output mismatches in {} distinct events: {}".format(len(events), mismatches))
+
+    with open(os.devnull, "w") as out:
+        legacy_time = measure(legacy, events, args.events, out)
+        direct_time = measure(direct, events, args.events, out)
+
+    print("Events:          {}".format(args.events))
+    print("minidom path:    {:.2f}s ({:.0f} events/s)".format(legacy_time, args.events / legacy_time))
+    print("direct path:     {:.2f}s ({:.0f} events/s)".format(direct_time, args.events / direct_time))
+    print("Speedup:         {:.1f}x".format(legacy_time / direct_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+from lib.hash_ring import HashRing
+
+from aiohttp import web
+import aiohttp
+import asyncio
+
+import logging
+import os
+import json
+
+# Routes requests between a set of transaction server nodes. Each user is
+# consistently hashed onto a node, so that any client (the workload generator,
+# or the web frontend) can scale out just by adding nodes to ROUTER_NODES.
+
+PORT = int(os.environ.get("ROUTER_PORT", 5000))
+NODES = [node.strip() for node in os.environ.get("ROUTER_NODES", "transaction-server:5000").split(",") if node.strip()]
+
+NODE_CONNECTIONS = 100 # Keep-alive connections kept open to each node.
+HEALTH_INTERVAL = 2 # Seconds between health checks of each node.
+HEALTH_TIMEOUT = 1 # Seconds a node has to respond to a health check.
+PIN_TIMEOUT = 600 # Seconds a user stays on the node that last served them.
+
+class Router(object):
+    def __init__(self, nodes):
+        self.ring = HashRing(nodes)
+        self.session = None
+
+        # Nodes are assumed to be up until a health check says otherwise.
+        self.healthy = set(nodes)
+
+        # The node that each recently active user was last sent to, and when.
+        # A node only acknowledges a transaction once it has queued it, so it
+        # may still be working through a user's transactions long after they
+        # were forwarded. Users stay on their node for PIN_TIMEOUT seconds
+        # after their last request (twice as long as a node keeps an idle
+        # user's state), and only move before then if their node refuses the
+        # connection. A failed health check only moves the users that are not
+        # pinned, so a node that is slow to answer never has a user's work
+        # split between it and another node.
+        self.pins = dict()
+
+        # The last request forwarded for each user that is still in flight.
+        # A request for a user waits for the one before it, so that requests
+        # reach the node in the order they were received here.
+        self.tails = dict()
+
+    def nodes_for(self, username):
+        """List the nodes to try for a user, the healthy ones first."""
+
+        if username:
+            candidates = list(self.ring.candidates(username))
+        else:
+            # Requests that do not belong to a user, such as the DUMPLOG for
+            # all users, can be handled by any node.
+            candidates = list(self.ring.nodes)
+
+        candidates.sort(key=lambda node: node not in self.healthy)
+
+        pinned = self._pinned(username)
+        if pinned:
+            candidates.remove(pinned)
+            candidates.insert(0, pinned)
+
+        return candidates
+
+    def _pinned(self, username):
+        pin = self.pins.get(username)
+        if pin and asyncio.get_event_loop().time() - pin[1] < PIN_TIMEOUT:
+            return pin[0]
+        return None
+
+    def _pin(self, username, node):
+        if username:
+            self.pins[username] = (node, asyncio.get_event_loop().time())
+
+    def _unpin(self, node):
+        """Release every user pinned to a node that has refused a connection."""
+
+        for username in [username for username, pin in self.pins.items() if pin[0] == node]:
+            del self.pins[username]
+
+    async def _send(self, node, path, body):
+        try:
+            async with self.session.post("http://{}{}".format(node, path), data=body) as response:
+                return web.Response(body=await response.read(),
+                        status=response.status,
+                        content_type=response.content_type)
+        except aiohttp.ClientConnectorError:
+            # The request never reached the node, so it is safe to send
+            # it to the next node for this user instead.
+            logger.warning("Node %s is not available.", node)
+            self.healthy.discard(node)
+            self._unpin(node)
+            return None
+
+    async def _post(self, username, path, body):
+        for node in self.nodes_for(username):
+            response = await self._send(node, path, body)
+            if response is not None:
+                self._pin(username, node)
+                return response
+
+        return web.json_response({"success": False}, status=503)
+
+    async def _in_order(self, usernames, send):
+        done = asyncio.get_event_loop().create_future()
+        previous = [self.tails.get(username) for username in usernames]
+        for username in usernames:
+            self.tails[username] = done
+
+        try:
+            for waiting in previous:
+                if waiting:
+                    await waiting
+            return await send()
+        finally:
+            done.set_result(None)
+            for username in usernames:
+                if self.tails.get(username) is done:
+                    del self.tails[username]
+
+    async def forward(self, username, path, body):
+        return await self._in_order([username], lambda: self._post(username, path, body))
+
+    async def _post_batch(self, part):
+        # Each transaction goes to the first node that it can. If a node
+        # is down, its transactions are split up again between the nodes
+        # that are left, so that every user still ends up on a single node.
+        results = dict()
+        for _ in self.ring.nodes:
+            nodes = dict()
+            for position, username, line in part:
+                node = self.nodes_for(username)[0]
+                nodes.setdefault(node, []).append((position, username, line))
+
+            async def send(node, lines):
+                body = "\n".join(line for _, _, line in lines).encode()
+                return node, lines, await self._send(node, "/batch", body)
+
+            part = []
+            for node, lines, response in await asyncio.gather(*[send(node, lines) for node, lines in nodes.items()]):
+                if response is None:
+                    part.extend(lines)
+                    continue
+
+                for _, username, _ in lines:
+                    self._pin(username, node)
+
+                if response.status != 200:
+                    results.update((position, False) for position, _, _ in lines)
+                else:
+                    statuses = json.loads(response.body.decode())["results"]
+                    results.update((position, status) for (position, _, _), status in zip(lines, statuses))
+
+            if not part:
+                break
+
+        return results
+
+    async def forward_batch(self, lines):
+        """Split a batch of transactions by node, and send each node its part."""
+
+        part = [(position, _transaction_user(line.encode()), line) for position, line in enumerate(lines)]
+        usernames = set(username for _, username, _ in part)
+        results = await self._in_order(usernames, lambda: self._post_batch(part))
+
+        return web.json_response({"results": [results.get(position, False) for position in range(len(lines))]})
+
+    async def _check(self, node):
+        try:
+            timeout = aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)
+            async with self.session.get("http://{}/health".format(node), timeout=timeout) as response:
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+
+        if healthy and node not in self.healthy:
+            logger.info("Node %s is available.", node)
+            self.healthy.add(node)
+        elif not healthy and node in self.healthy:
+            logger.warning("Node %s failed its health check.", node)
+            self.healthy.discard(node)
+
+    async def health_checker(self):
+        while True:
+            await asyncio.gather(*[self._check(node) for node in self.ring.nodes])
+
+            # Forget the users that have not been active for a while.
+            now = asyncio.get_event_loop().time()
+            for username in [username for username, pin in self.pins.items() if now - pin[1] >= PIN_TIMEOUT]:
+                del self.pins[username]
+
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+def _transaction_user(body):
+    # Transactions are of the form '[n] COMMAND,username,...', apart from
+    # the DUMPLOG for all users, which only has a filename.
+    fields = body.decode().strip().split(",")
+    if len(fields) < 2 or (len(fields) == 2 and fields[0].endswith("DUMPLOG")):
+        return None
+
+    return fields[1].strip()
+
+def _payload_user(body):
+    try:
+        return json.loads(body.decode())["username"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _handler(path, get_username):
+    async def handle(request):
+        body = await request.read()
+        return await router.forward(get_username(body), path, body)
+    return handle
+
+async def batch(request):
+    body = await request.read()
+    lines = [line for line in body.decode().splitlines() if line.strip()]
+    return await router.forward_batch(lines)
+
+async def nodes(request):
+    info = {
+        "nodes": router.ring.nodes,
+        "healthy": sorted(router.healthy),
+        "pinned_users": len(router.pins)
+    }
+    return web.json_response(info)
+
+async def on_startup(app):
+    # Requests are forwarded over a pool of keep-alive connections, rather
+    # than opening a connection to the node for every request.
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=NODE_CONNECTIONS)
+    router.session = aiohttp.ClientSession(connector=connector)
+    app["health_checker"] = asyncio.get_event_loop().create_task(router.health_checker())
+
+async def on_cleanup(app):
+    app["health_checker"].cancel()
+    await router.session.close()
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+router = Router(NODES)
+logger.info("Routing between nodes %s.", NODES)
+
+app = web.Application()
+app.router.add_post("/", _handler("/", _transaction_user))
+app.router.add_post("/batch", batch)
+app.router.add_post("/api", _handler("/api", _payload_user))
+app.router.add_post("/status", _handler("/status", _payload_user))
+app.router.add_get("/nodes", nodes)
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
+
+web.run_app(app, host="0.0.0.0", port=PORT)
@@ -0,0 +1,226 @@
+import lib.parser as parser
+from lib.sharding import shard_for
+
+from aiohttp import web
+import aiohttp
+import asyncio
+import subprocess
+
+import logging
+import sys
+import os
+import json
+
+# Runs a number of transaction server processes, and routes each request to
+# the process that serves its user. A single server only ever uses one core,
+# and running several behind a plain load balancer would let 2 processes work
+# on the same user at once. Hashing on the username means that each user is
+# still processed in order, by exactly one worker.
+
+PORT = 5000
+WORKER_PORT = 5001 # Workers listen on consecutive ports starting here.
+WORKERS = int(os.environ.get("WORKERS", os.cpu_count() or 1))
+
+# The connection limits of a single server, which are split between the
+# workers so that the database sees the same number of connections.
+CONN_MIN = 100
+CONN_MAX = 1000
+
+FORWARD_CONNECTIONS = 100 # Keep-alive connections kept open to each worker.
+CONNECT_RETRIES = 60 # Attempts to reach a worker that is still starting up.
+CONNECT_INTERVAL = 1 # Seconds between attempts to reach a worker.
+WORKER_CHECK_INTERVAL = 1 # Seconds between checks for workers that have exited.
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+class Worker(object):
+    def __init__(self, index):
+        self.index = index
+        self.port = WORKER_PORT + index
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update({
+                "PORT": str(self.port),
+                "WORKER_INDEX": str(self.index),
+                "WORKER_COUNT": str(WORKERS),
+                "CONN_MIN": str(max(CONN_MIN // WORKERS, 1)),
+                "CONN_MAX": str(max(CONN_MAX // WORKERS, 1))
+        })
+
+        logger.info("Starting worker %s on port %s.", self.index, self.port)
+        self.process = subprocess.Popen([sys.executable, SERVER], env=env)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+class Router(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.session = None
+
+        # The last request forwarded for each user that is still in flight.
+        # A request for a user waits for the one before it, so that requests
+        # reach the worker in the order they were received here. A batch is
+        # treated as a request by each of the users in it.
+        self.tails = dict()
+
+    def worker_for(self, username):
+        if not username:
+            # Requests that do not belong to a user, such as the DUMPLOG for
+            # all users or an invalid transaction, can be handled by any worker.
+            return self.workers[0]
+
+        return self.workers[shard_for(username, len(self.workers))]
+
+    async def _post(self, worker, path, body):
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                async with self.session.post(worker.url + path, data=body) as response:
+                    return web.Response(body=await response.read(),
+                            status=response.status,
+                            content_type=response.content_type)
+            except aiohttp.ClientConnectorError:
+                # The request never reached the worker, so it is safe to send
+                # again. This happens while a worker is (re)starting.
+                logger.info("Worker %s is not available, trying again in %s seconds...",
+                        worker.index, CONNECT_INTERVAL)
+                await asyncio.sleep(CONNECT_INTERVAL)
+
+        return web.json_response({"success": False}, status=503)
+
+    async def _in_order(self, usernames, send):
+        done = asyncio.get_event_loop().create_future()
+        previous = [self.tails.get(username) for username in usernames]
+        for username in usernames:
+            self.tails[username] = done
+
+        try:
+            for waiting in previous:
+                if waiting:
+                    await waiting
+            return await send()
+        finally:
+            done.set_result(None)
+            for username in usernames:
+                if self.tails.get(username) is done:
+                    del self.tails[username]
+
+    async def forward(self, username, path, body):
+        worker = self.worker_for(username)
+        return await self._in_order([username], lambda: self._post(worker, path, body))
+
+    async def forward_batch(self, lines):
+        """Split a batch of transactions by worker, and send each worker its part."""
+
+        parts = dict()
+        for position, line in enumerate(lines):
+            username = _transaction_user(line.encode())
+            worker = self.worker_for(username)
+            parts.setdefault(worker, []).append((position, username, line))
+
+        async def send(worker, part):
+            usernames = set(username for _, username, _ in part)
+            body = "\n".join(line for _, _, line in part).encode()
+            response = await self._in_order(usernames, lambda: self._post(worker, "/batch", body))
+
+            if response.status != 200:
+                return [(position, False) for position, _, _ in part]
+
+            results = json.loads(response.body.decode())["results"]
+            return [(position, result) for (position, _, _), result in zip(part, results)]
+
+        results = [None] * len(lines)
+        for part in await asyncio.gather(*[send(worker, part) for worker, part in parts.items()]):
+            for position, result in part:
+                results[position] = result
+
+        return web.json_response({"results": results})
+
+def _transaction_user(body):
+    command = parser.parse(body.decode())
+    return command.username if command else None
+
+def _payload_user(body):
+    try:
+        return json.loads(body.decode())["username"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _handler(path, get_username):
+    async def handle(request):
+        body = await request.read()
+        return await router.forward(get_username(body), path, body)
+    return handle
+
+async def batch(request):
+    body = await request.read()
+    lines = [line for line in body.decode().splitlines() if line.strip()]
+    return await router.forward_batch(lines)
+
+async def health(request):
+    # Answered here rather than by the workers, so that it stays cheap when
+    # the workers are busy.
+    return web.json_response({"success": True})
+
+async def metrics(request):
+    results = []
+    for worker in router.workers:
+        try:
+            async with router.session.get(worker.url + "/metrics") as response:
+                results.append(await response.json())
+        except aiohttp.ClientError:
+            results.append(None)
+
+    return web.json_response({"workers": results})
+
+async def supervise(workers):
+    """Restart any worker that exits, so its users are not left unserved."""
+
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        for worker in workers:
+            code = worker.process.poll()
+            if code is not None:
+                logger.error("Worker %s exited with code %s, restarting.", worker.index, code)
+                worker.start()
+
+async def on_startup(app):
+    # Requests are forwarded over a pool of keep-alive connections, rather
+    # than opening a connection to the worker for every request.
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=FORWARD_CONNECTIONS)
+    router.session = aiohttp.ClientSession(connector=connector)
+    app["supervisor"] = asyncio.get_event_loop().create_task(supervise(router.workers))
+
+async def on_cleanup(app):
+    app["supervisor"].cancel()
+    await router.session.close()
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+workers = [Worker(index) for index in range(WORKERS)]
+router = Router(workers)
+
+app = web.Application()
+app.router.add_post("/", _handler("/", _transaction_user))
+app.router.add_post("/batch", batch)
+app.router.add_post("/api", _handler("/api", _payload_user))
+app.router.add_post("/status", _handler("/status", _payload_user))
+app.router.add_get("/health", health)
+app.router.add_get("/metrics", metrics)
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
+
+for worker in workers:
+    worker.start()
+
+try:
+    web.run_app(app, host="0.0.0.0", port=PORT)
+finally:
+    for worker in workers:
+        worker.stop()
@@ -1,7 +1,13 @@
+from lib.quote_pool import QuotePool
+from lib.trigger_book import TriggerBook
+from lib.state import invalidate_account, forget_user, forget_all
+from lib.sharding import owns, shard_for
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 import traceback
 import asyncio
+import heapq
 import logging
 import socket
 import time
@@ -12,110 +18,325 @@ QUOTE_LIFESPAN = 60 # Time a quote is valid for (60 in production).
 
 #QUOTE_CACHE_HOST = "192.168.1.249"
 #QUOTE_CACHE_PORT = 6000
-QUOTE_CACHE_HOST = "quoteserve.seng.uvic.ca"
-QUOTE_CACHE_PORT = 4444
+QUOTE_CACHE_HOST = os.environ.get("QUOTE_CACHE_HOST", "quoteserve.seng.uvic.ca")
+QUOTE_CACHE_PORT = int(os.environ.get("QUOTE_CACHE_PORT", 4444))
 QUOTE_SERVER_PRESENT = os.environ['http_proxy']
-QUOTE_LIMIT=100
+QUOTE_LIMIT=100 # Number of persistent connections to the quote server.
+
+# The trigger sweep is spread evenly over each QUOTE_LIFESPAN, rather than
+# checking every stock at once. Each stock always falls in the same slot.
+TRIGGER_SLOTS = int(os.environ.get("TRIGGER_SLOTS", QUOTE_LIFESPAN))
+TRIGGER_CONCURRENCY = int(os.environ.get("TRIGGER_CONCURRENCY", 10)) # Quotes the sweep waits on at once.
+
+# The sweep could never run with either of these below 1.
+if TRIGGER_SLOTS < 1:
+    raise ValueError("TRIGGER_SLOTS must be at least 1, not {}.".format(TRIGGER_SLOTS))
+if TRIGGER_CONCURRENCY < 1:
+    raise ValueError("TRIGGER_CONCURRENCY must be at least 1, not {}.".format(TRIGGER_CONCURRENCY))
+
+# When set, each user's worker keeps their account in memory, so that commands
+# which cannot succeed are turned away without going to the database.
+ACCOUNT_CACHE = bool(os.environ.get("ACCOUNT_CACHE"))
 
 logger = logging.getLogger(__name__)
-host = socket.gethostname()
 
 # These must be initialized from the entry point to ensure that
 # the loop matches. It is guaranteed to run before anything
 # tries to access it, as the entry point calls init() before
 # processing any transactions.
-reservation_timestamp_queue = None
+reservations_added = None
+price_updates = None
+fresh_prices = None
 loop = None
-quote_sem = None
+quote_pool = None
+
+# Reservations waiting to expire, as a heap of (expiry time, reservationid).
+# The expiry times are wall clock times, like the timestamps stored with each
+# reservation, so that every node agrees on when a reservation expires. A
+# reservation may be committed or cancelled before it expires, in which case
+# it is simply not found when its batch is expired.
+reservation_expiries = []
+
+EXPIRY_RETRY_INTERVAL = 1 # Seconds to wait before expiring a batch that failed.
+
+# Workers tell each other about changes to the accounts of users they do not
+# serve themselves, by notifying this channel with the username.
+ACCOUNT_CHANNEL = "accounts" # Must match the notify_accounts statement.
+LISTEN_CHECK_INTERVAL = 5 # Seconds between checks that the listening connection is open.
+LISTEN_RETRY_INTERVAL = 1 # Seconds to wait before listening again after a failure.
+
+# Workers also tell each other every price they fetch from the quote server,
+# as the triggers on a stock are spread over the workers of every node.
+PRICE_CHANNEL = "prices" # Must match the notify_prices statement.
+
+# Identifies this worker's own prices, as every worker hears all of them.
+SENDER = "{}:{}".format(socket.gethostname(), os.getpid())
+
+# How the trigger sweep is keeping up. The lag is how many seconds late a
+# slot of the sweep started, which grows if the slots take too long.
+sweep_stats = {
+        "slots": 0,
+        "stocks_checked": 0,
+        "last_lag": 0.0,
+        "max_lag": 0.0
+}
+
+# Quotes are valid for QUOTE_LIFESPAN seconds, so they are cached locally
+# for that long. Maps a stock symbol to a tuple of (expiry time, quote).
+quote_cache = dict()
+
+# The live triggers of the users served by this process, by stock.
+trigger_book = TriggerBook()
+
+# Quote requests that are currently in flight. Maps a stock symbol to the
+# future that will hold the quote, so that concurrent requests for the
+# same stock can wait on a single request to the quote server.
+pending_quotes = dict()
 
 def init(entry_loop):
-    global quote_sem
-    quote_sem = asyncio.Semaphore(QUOTE_LIMIT, loop=entry_loop)
+    global quote_pool
+    quote_pool = QuotePool(QUOTE_CACHE_HOST, QUOTE_CACHE_PORT, QUOTE_LIMIT, entry_loop)
 
     global loop
     loop = entry_loop
 
-    # Note that the expiry times stored in the queue do not necessarily correlate
-    # with the reservation rows, due to clock drift and the passing of time
-    # between method calls. The queue simply acts as a method to let the handler
-    # go idle, and does not dictate which rows should be removed.
-    # 
-    # When the handler is active, it will remove every row that it can, regardless
-    # of the state of the queue. It is possible that the handler wakes up and has
-    # no reservations to process, as a buy/sell can be committed with no way to
-    # remove the matching timestamp from the queue.
-    global reservation_timestamp_queue
-    reservation_timestamp_queue = asyncio.Queue(loop=entry_loop)
+    # Set whenever a reservation is added, so that the handler can go idle
+    # while there is nothing to expire.
+    global reservations_added
+    reservations_added = asyncio.Event(loop=entry_loop)
+
+    # Fresh prices from the quote server, as (stock symbol, price), so that
+    # the triggers on a stock are checked as soon as a new price is seen.
+    global price_updates
+    price_updates = asyncio.Queue(loop=entry_loop)
+
+    # Prices fetched from the quote server by this worker, as (stock symbol,
+    # price), waiting to be passed on to the other workers.
+    global fresh_prices
+    fresh_prices = asyncio.Queue(loop=entry_loop)
+
+def _expire_later(reservation, expiry_time):
+    heapq.heappush(reservation_expiries, (expiry_time, reservation))
+    reservations_added.set()
+
+async def _load_reservations(pool):
+    # Reservations left by a previous run still need to expire. Each worker
+    # only expires those of the users that it serves, and another worker that
+    # made reservations for them expires those itself. The clock may have been
+    # set back since they were made, but none can have longer than
+    # QUOTE_LIFESPAN left.
+    latest = round(time.time()) + QUOTE_LIFESPAN
+    async with pool.acquire() as conn:
+        get_reservations = conn.statement("get_reservations")
+        for record in await get_reservations.fetch():
+            if owns(record["username"]):
+                _expire_later(record["reservationid"], min(record["timestamp"], latest))
+
+    logger.info("Loaded %s reservations waiting to expire.", len(reservation_expiries))
 
 async def reservation_timeout_handler(pool):
     """Helper function - used to cancel buy/sell orders after they timeout."""
 
-    # Block until the first expiry time is available.
-    expiry_time = await reservation_timestamp_queue.get()
-    logging.debug("Expiry time %s retreived", expiry_time)
+    await _load_reservations(pool)
 
     while True:
-        
-        now = round(loop.time())
-        sleep_time = expiry_time - now
 
-        # If this is <= 0 then the method will return right away.
-        logging.debug("Sleeping for %s", sleep_time)
-        await asyncio.sleep(sleep_time)
-        logging.debug("Done sleeping for %s", sleep_time)
+        # Wait for the earliest reservation to expire, or for one to be added,
+        # as reservations picked up from elsewhere can expire any time.
+        now = round(time.time())
+        if not reservation_expiries or reservation_expiries[0][0] > now:
+            sleep_time = reservation_expiries[0][0] - now if reservation_expiries else None
+            logging.debug("Sleeping for %s", sleep_time)
 
-        # Loops until all currently expired transactions have been dealt with.
-        while True:
+            reservations_added.clear()
             try:
-                async with pool.acquire() as conn:
-                    async with conn.transaction():
+                await asyncio.wait_for(reservations_added.wait(), sleep_time, loop=loop)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # A reservation has expired once the current time is no longer
+        # before its expiry time, matching the commands that use them.
+        expired = []
+        while reservation_expiries and reservation_expiries[0][0] <= now:
+            expired.append(heapq.heappop(reservation_expiries))
+
+        try:
+            async with pool.acquire() as conn:
+                expire_reserved = conn.statement("expire_reserved")
+                records = await expire_reserved.fetch([reservation for _, reservation in expired])
+
+                # The refunds changed these accounts behind the backs of their workers.
+                await _changed(conn, set(record["username"] for record in records))
+
+            logging.debug("Expired %s of %s reservations", len(records), len(expired))
+        except:
+            logger.exception("Buy/sell timeout task failed to commit.")
+
+            # An exception should not stop the entire task, so
+            # the batch is put back to be tried again later.
+            for item in expired:
+                heapq.heappush(reservation_expiries, item)
+            await asyncio.sleep(EXPIRY_RETRY_INTERVAL)
+
+async def _changed(conn, usernames):
+    """Helper function - lets the workers that serve these users know that their accounts changed."""
+
+    # The users served here are dealt with before anything is awaited, so
+    # that no command of theirs can see the account from before the change.
+    elsewhere = []
+    for username in usernames:
+        if owns(username):
+            invalidate_account(username)
+        else:
+            elsewhere.append(username)
 
-                        delete_reserved =   "DELETE FROM reserved       " \
-                                            "WHERE timestamp < $1       " \
-                                            "RETURNING *;               " 
+    if elsewhere:
+        notify_accounts = conn.statement("notify_accounts")
+        await notify_accounts.fetch(elsewhere)
 
-                        target_timestamp = round(time.time(), 5)
-                        reservation = await conn.fetchrow(delete_reserved, target_timestamp)
+async def account_changed(user_id, **settings):
+    """Tell the worker that serves a user that this one has served them instead."""
 
-                        # There are no more expired reservations
-                        if not reservation:
-                            logging.debug("No reservations found, breaking")
-                            break
+    async with _connection(settings) as conn:
+        await _changed(conn, [user_id])
 
-                        logging.debug("Found reservation %s of type %s",
-                                reservation["reservationid"], reservation["type"])
+async def _adopt(pool, username):
+    """Helper function - picks up the triggers and reservations that another worker made for a user."""
 
-                        if reservation["type"] == "buy":
+    # The triggers are loaded again as a whole, as any of them may have been
+    # set or cancelled. Reservations that were already waiting to expire here
+    # are simply expired twice, which does nothing the second time.
+    latest = round(time.time()) + QUOTE_LIFESPAN
+    async with pool.acquire() as conn:
+        get_user_triggers = conn.statement("get_user_triggers")
+        triggers = await get_user_triggers.fetch(username)
+        get_user_reservations = conn.statement("get_user_reservations")
+        reservations = await get_user_reservations.fetch(username, round(time.time()))
 
-                            users_update =  "UPDATE users " \
-                                            "SET balance = balance + $1 " \
-                                            "WHERE username = $2;"
-                            await conn.execute(users_update, reservation["amount"], reservation["username"])
+    trigger_book.remove_user(username)
+    for record in triggers:
+        trigger_book.add(record["username"], record["stock_symbol"], record["type"],
+                record["trigger_amount"], record["transaction_number"])
 
-                        else:
+    for record in reservations:
+        _expire_later(record["reservationid"], min(record["timestamp"], latest))
 
-                            stocks_update = "UPDATE stocks " \
-                                            "SET stock_quantity = stock_quantity + $1 " \
-                                            "WHERE username = $2 " \
-                                            "AND stock_symbol = $3;"
-                            await conn.execute(stocks_update, reservation["stock_quantity"],
-                                    reservation["username"], reservation["stock_symbol"])
-            except:
-                logger.exception("Buy/sell timeout task failed to commit.")
+    logger.debug("Adopted %s triggers and %s reservations of %s.", len(triggers), len(reservations), username)
 
-                # An exception should not
-                # stop the entire task.
-                pass
+async def _adopt_safely(pool, username):
+    try:
+        await _adopt(pool, username)
+    except:
+        logger.exception("Picking up the triggers and reservations of %s failed.", username)
 
-        expired = True
-        while expired:
-            expiry_time = await reservation_timestamp_queue.get()
-            now = round(loop.time())
-            expired = expiry_time <= now 
-            logging.debug("Expired=%s based on now:%s, expiry:%s", expired, now, expiry_time)
+async def listener(pool):
+    """Listens for other workers changing the accounts of users served here, and for the prices they fetch."""
 
-async def get_quote(user_id, stock_symbol):
-    """Fetch a quote from the quote cache."""
+    def changed(conn, pid, channel, username):
+        if owns(username):
+            forget_user(username)
+            loop.create_task(_adopt_safely(pool, username))
+
+    def priced(conn, pid, channel, payload):
+        sender, stock_symbol, price = json.loads(payload)
+        if sender != SENDER and stock_symbol in trigger_book.sides:
+            price_updates.put_nowait((stock_symbol, price))
+
+    listened = False
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                await conn.add_listener(ACCOUNT_CHANNEL, changed)
+                await conn.add_listener(PRICE_CHANNEL, priced)
+                logger.info("Listening for account changes and prices.")
+
+                if listened:
+                    # Anything notified while not listening was missed, so
+                    # everything that could have changed is loaded again.
+                    forget_all()
+                    await _load_triggers(pool)
+                    await _load_reservations(pool)
+                listened = True
+
+                while not conn.is_closed():
+                    await asyncio.sleep(LISTEN_CHECK_INTERVAL)
+        except:
+            logger.exception("Listening for account changes and prices failed.")
+
+        await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+@asynccontextmanager
+async def _connection(settings):
+    """Helper function - holds a connection only for the duration of a command's database work."""
+
+    # Commands only take a connection for their database work, so that
+    # one isn't held while waiting on something else, such as a quote.
+    # Executors own a connection, which is used instead if provided.
+    #
+    # Each command does all of its work in a single statement, which is
+    # atomic by itself, so there is no need for an explicit transaction.
+    conn = settings.get("conn")
+    if conn:
+        yield conn
+    else:
+        async with settings["pool"].acquire() as conn:
+            yield conn
+
+async def _user_state(settings):
+    """Helper function - returns the user's state, loading it if this is the first use."""
+
+    # A worker serving a user for another node reloads their reservations
+    # every time, as the user's own node may have made or used some since.
+    state = settings["state"]
+    load_reservations = not state.loaded or not state.owned
+    load_account = ACCOUNT_CACHE and state.owned and not state.account_loaded
+    if load_reservations or load_account:
+        async with _connection(settings) as conn:
+            if load_reservations:
+                await state.load(conn, round(time.time()))
+            if load_account:
+                await state.load_account(conn)
+    return state
+
+async def _account(settings):
+    """Helper function - returns the user's state, with their account loaded if it is cached."""
+
+    state = settings["state"]
+    if ACCOUNT_CACHE and state.owned and not state.account_loaded:
+        async with _connection(settings) as conn:
+            await state.load_account(conn)
+    return state
+
+def _add_trigger(state, stock_symbol, trigger_type, trigger_amount, transaction_number):
+    """Helper function - watches a trigger, if this worker serves its user."""
+
+    # Otherwise the worker that serves the user is told that their account
+    # changed, and picks the trigger up from the database.
+    if state.owned:
+        trigger_book.add(state.username, stock_symbol, trigger_type, trigger_amount, transaction_number)
+
+def _remove_trigger(state, stock_symbol, trigger_type):
+    if state.owned:
+        trigger_book.remove(state.username, stock_symbol, trigger_type)
+
+def _cached_quote(stock_symbol):
+    """Helper function - returns the cached quote for a stock if it is still valid."""
+
+    entry = quote_cache.get(stock_symbol)
+    if not entry:
+        return None
+
+    expiry_time, cached = entry
+    if expiry_time <= loop.time():
+        # The quote is no longer valid, so it can never be served again.
+        del quote_cache[stock_symbol]
+        return None
+
+    return cached
+
+async def _fetch_quote(user_id, stock_symbol):
+    """Fetch a quote from the quote server, bypassing the local cache."""
 
     request = "{symbol},{user}\r".format(symbol=stock_symbol.strip(), user=user_id.strip())
     encoded = request.encode("ascii")
@@ -123,55 +344,74 @@ async def get_quote(user_id, stock_symbol):
     result = None
 
     while not result:
-        async with quote_sem:
-            try:
-                if QUOTE_SERVER_PRESENT:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-                    with sock:
-                        #sock.setblocking(False)
-
-                        sock.bind((host, 0))
-                        await loop.sock_connect(sock, (QUOTE_CACHE_HOST, QUOTE_CACHE_PORT))
-                        #await loop.sock_connect(sock, (QUOTE_CACHE_HOST, QUOTE_CACHE_PORT))
-
-                        #reader, writer = await asyncio.open_connection(QUOTE_CACHE_HOST, QUOTE_CACHE_PORT, sock=sock, loop=loop)
-                    #reader, writer = await asyncio.open_connection(QUOTE_CACHE_HOST, QUOTE_CACHE_PORT, local_addr=("127.0.0.1", 1245), loop=loop)
+        try:
+            if QUOTE_SERVER_PRESENT:
+                raw = await quote_pool.request(encoded)
+                decoded = raw.decode("ascii")
+                result = decoded.strip()
 
-                        await loop.sock_sendall(sock, encoded)
-                        raw = await loop.sock_recv(sock, 1024)
-
-
-                        #writer.write(encoded)
-
-                        #raw = await reader.read(1024)
-                        decoded = raw.decode("ascii")
-                        result = decoded.strip()
+            else:
+                # This sleep will mock production delays
+                # await asyncio.sleep(2)
+                result = "20.00,BAD,usernamehere,1549827515,crytoKEY=123=o"
 
-                        #writer.close()
-                        #await writer.wait_closed()
+        except:
+            logger.exception("Quote attempt failed for %s and %s.", user_id, stock_symbol)
 
-                        #try:
-                        sock.shutdown(socket.SHUT_RDWR)
-                        #except:
-                            # Sometimes this fails as the server has already
-                            # closed the socket. If this happens, the correct
-                            # outcome has aready been achieved, skip.
-                            #pass
+            # Some form of error occurred, try again.
+            pass
 
-                else:
-                    # This sleep will mock production delays
-                    # await asyncio.sleep(2)
-                    result = "20.00,BAD,usernamehere,1549827515,crytoKEY=123=o"
+    price, symbol, username, timestamp, cryptokey = result.split(",")
+    return float(price), int(timestamp), cryptokey, username
 
-            except:
-                logger.exception("Quote attempt failed for %s and %s.", user_id, stock_symbol)
+async def get_quote(user_id, stock_symbol):
+    """Fetch a quote, serving it from the local cache if a valid one exists.
 
-                # Some form of error occurred, try again.
-                pass
+    The final element of the result is True if the quote came from the cache,
+    and False if the quote server was actually hit.
+    """
 
-    price, symbol, username, timestamp, cryptokey = result.split(",")
-    return float(price), int(timestamp), cryptokey, username
+    while True:
+        cached = _cached_quote(stock_symbol)
+        if cached:
+            logger.debug("Serving quote for %s from cache.", stock_symbol)
+            return cached + (True,)
+
+        pending = pending_quotes.get(stock_symbol)
+        if not pending:
+            break
+
+        # Another caller is already fetching this stock, so wait on their
+        # result rather than sending an identical request. The shield keeps
+        # a cancelled waiter from cancelling the request for everyone else.
+        logger.debug("Waiting on in-flight quote for %s.", stock_symbol)
+        try:
+            fetched = await asyncio.shield(pending)
+            return fetched + (True,)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+
+            # The caller that was fetching the quote was cancelled, so
+            # go around again and fetch it ourselves.
+
+    pending = loop.create_future()
+    pending_quotes[stock_symbol] = pending
+
+    try:
+        # The quote is only valid for QUOTE_LIFESPAN seconds from when it was
+        # requested, so the expiry is based on the time before the request.
+        expiry_time = loop.time() + QUOTE_LIFESPAN
+        fetched = await _fetch_quote(user_id, stock_symbol)
+        quote_cache[stock_symbol] = (expiry_time, fetched)
+        pending.set_result(fetched)
+    except:
+        pending.cancel()
+        raise
+    finally:
+        del pending_quotes[stock_symbol]
+
+    return fetched + (False,)
 
 # quote() is called when a client requests a quote.  It will return a valid price for the
 # stock as requested.
@@ -179,7 +419,18 @@ async def quote(transaction_num, user_id, stock_symbol, **settings):
     publisher = settings["publisher"]
 
     # get quote from server/cache
-    new_price, time_of_quote, cryptokey, quote_user = await get_quote(user_id, stock_symbol)
+    new_price, time_of_quote, cryptokey, quote_user, cached = await get_quote(user_id, stock_symbol)
+
+    if cached:
+        # Only actual hits to the quote server are logged.
+        return new_price, stock_symbol, user_id, time_of_quote, cryptokey
+
+    fresh_prices.put_nowait((stock_symbol, new_price))
+
+    # Any triggers on the stock can be checked against the new price straight
+    # away, rather than waiting for the trigger maintainer to get a quote.
+    if stock_symbol in trigger_book.sides and not settings.get("checks_triggers"):
+        price_updates.put_nowait((stock_symbol, new_price))
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -201,7 +452,6 @@ async def quote(transaction_num, user_id, stock_symbol, **settings):
 
 async def add(transaction_num, user_id, amount, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -217,17 +467,15 @@ async def add(transaction_num, user_id, amount, **settings):
     }
     await publisher.publish_message(json.dumps(message))
     
-    query =  "INSERT INTO users (username, balance) " \
-             "VALUES ($1, $2) " \
-             "ON CONFLICT (username) DO UPDATE " \
-             "SET balance = users.balance + $2 " \
-             "WHERE users.username = $1;"
-
     logger.info("Executing add command for transaction %s", transaction_num)
-    async with conn.transaction():
-        await conn.execute(query, user_id, float(amount))
+    account = await _account(settings)
+    async with _connection(settings) as conn:
+        add_funds = conn.statement("add_funds")
+        await add_funds.fetch(user_id, float(amount))
         logger.debug("Balance update for %s sucessful.", transaction_num)
-        
+
+    account.credit(float(amount))
+
     data = {
         "timestamp": int(time.time() * 1000), 
         "server": "DDJK",
@@ -242,26 +490,8 @@ async def add(transaction_num, user_id, amount, **settings):
     }
     await publisher.publish_message(json.dumps(message))
 
-async def _get_latest_reserved(transaction_type, user_id, conn):
-
-    selection = "SELECT reservationid, stock_symbol, stock_quantity, amount " \
-                "FROM reserved " \
-                "WHERE type = $1 " \
-                "AND username = $2 " \
-                "AND timestamp = ( " \
-                    "SELECT MAX(timestamp) " \
-                    "FROM reserved " \
-                    "WHERE type = $1 " \
-                    "AND username = $2 " \
-                ") " \
-                "AND timestamp > $3;"
-
-    target_timestamp = round(loop.time()) # Current time is threshold for expiry.
-    return await conn.fetchrow(selection, transaction_type, user_id, target_timestamp)
-
 async def buy(transaction_num, user_id, stock_symbol, amount, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -306,58 +536,53 @@ async def buy(transaction_num, user_id, stock_symbol, amount, **settings):
 
 
     logger.info("Executing buy command for transaction %s", transaction_num)
-    async with conn.transaction():
-
-        balance_check = "SELECT * FROM users " \
-                        "WHERE username = $1 " \
-                        "AND balance >= $2;"
-
-        result = await conn.fetchrow(balance_check, user_id, purchase_price)
-
-        if not result:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "BUY",
-                "username": user_id,
-                "stock_symbol": stock_symbol,
-                "funds": purchase_price,
-                "error_message": "Funds insufficient to purchase requested stock."
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("Funds insufficient to purchase requested stock for %s", transaction_num)
-            return "Funds insufficient to purchase requested stock."
-
-
-        balance_update =    "UPDATE users " \
-                            "SET balance = balance - $1 " \
-                            "WHERE username = $2;"
-
-        # Only reserve the exact amount needed to buy the stock
-        await conn.execute(balance_update, purchase_price, user_id)
-        logger.debug("Balance update for %s sucessful.", transaction_num)
+    state = await _user_state(settings)
+
+    # The cached balance can rule the purchase out without going to the database.
+    reservation = None
+    if state.covers(purchase_price):
+        async with _connection(settings) as conn:
+
+            # Only reserve the exact amount needed to buy the stock. It is possible that we have
+            # an identical reservation already, however we add this seperately since a COMMIT_BUY
+            # only needs to confirm the most recent, not both.
+            reserve = conn.statement("buy")
+
+            timestamp = round(time.time()) + QUOTE_LIFESPAN # Expiry time.
+            reservation = await reserve.fetchval(user_id, stock_symbol, purchase_price,
+                    stock_quantity, price, timestamp)
+
+        if not reservation:
+            # The cached balance was out of date.
+            state.invalidate()
+
+    if not reservation:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "BUY",
+            "username": user_id,
+            "stock_symbol": stock_symbol,
+            "funds": purchase_price,
+            "error_message": "Funds insufficient to purchase requested stock."
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
 
-        # It is possible that we have an identical reservation already, however we add this
-        # seperately since a COMMIT_BUY only needs to confirm the most recent, not both.
-        reserved_update =   "INSERT INTO reserved " \
-                            "(type, username, stock_symbol, stock_quantity, price, amount, timestamp) " \
-                            "VALUES " \
-                            "('buy', $1, $2, $3, $4, $5, $6);"
+        logger.info("Funds insufficient to purchase requested stock for %s", transaction_num)
+        return "Funds insufficient to purchase requested stock."
 
-        timestamp = round(loop.time()) + QUOTE_LIFESPAN # Expiry time.
-        await conn.execute(reserved_update, user_id, stock_symbol,
-                stock_quantity, price, purchase_price, timestamp)
-        logger.debug("Reserved update for %s sucessful.", transaction_num)
+    logger.debug("Reservation %s for %s sucessful.", reservation, transaction_num)
 
-        # Mark for expiry in QUOTE_LIFESPAN seconds.
-        await reservation_timestamp_queue.put(timestamp)
+    # Mark for expiry in QUOTE_LIFESPAN seconds.
+    _expire_later(reservation, timestamp)
 
+    state.reserve("buy", reservation, timestamp)
+    state.debit(purchase_price)
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -375,7 +600,6 @@ async def buy(transaction_num, user_id, stock_symbol, amount, **settings):
 
 async def commit_buy(transaction_num, user_id, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -390,44 +614,42 @@ async def commit_buy(transaction_num, user_id, **settings):
     }
     await publisher.publish_message(json.dumps(message))
     
-    async with conn.transaction():
-
-        selected = await _get_latest_reserved("buy", user_id, conn)
-        if not selected:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "COMMIT_BUY",
-                "username": user_id,
-                "error_message": "No BUY to commit" 
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("No buy to commit for %s", transaction_num)
-            return "No BUY to commit" 
-
-        stocks_update = "INSERT INTO stocks (username, stock_symbol, stock_quantity) " \
-                        "VALUES ($1, $2, $3) " \
-                        "ON CONFLICT (username, stock_symbol) DO UPDATE " \
-                        "SET stock_quantity = stocks.stock_quantity + $3 " \
-                        "WHERE stocks.username = $1 " \
-                        "AND stocks.stock_symbol = $2;"
-        
-        await conn.execute(stocks_update, user_id, selected["stock_symbol"], selected["stock_quantity"])
-        
-        reservation_delete =    "DELETE FROM reserved " \
-                                "WHERE reservationid = $1;"
-
-        await conn.execute(reservation_delete, selected["reservationid"])
+    # Only the reservation found in memory is touched, so there is no need
+    # to go to the database if the user has nothing to commit.
+    state = await _user_state(settings)
+    reservation = state.latest("buy", round(time.time()))
+
+    selected = None
+    if reservation:
+        async with _connection(settings) as conn:
+
+            commit = conn.statement("commit_buy")
+            selected = await commit.fetchrow(reservation)
+
+        state.remove_latest("buy")
+
+    if not selected:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "COMMIT_BUY",
+            "username": user_id,
+            "error_message": "No BUY to commit" 
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("No buy to commit for %s", transaction_num)
+        return "No BUY to commit" 
+
+    state.add_stock(selected["stock_symbol"], selected["stock_quantity"])
 
 async def cancel_buy(transaction_num, user_id, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -442,38 +664,39 @@ async def cancel_buy(transaction_num, user_id, **settings):
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    # Only the reservation found in memory is touched, so there is no need
+    # to go to the database if the user has nothing to cancel.
+    state = await _user_state(settings)
+    reservation = state.latest("buy", round(time.time()))
 
-        selected = await _get_latest_reserved("buy", user_id, conn)
-        if not selected:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "CANCEL_BUY",
-                "username": user_id,
-                "error_message": "No BUY to cancel" 
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
+    selected = None
+    if reservation:
+        async with _connection(settings) as conn:
 
-            logger.info("No buy to cancel for %s", transaction_num)
-            return "No BUY to cancel" 
+            credit_reserved = conn.statement("credit_reserved")
+            selected = await credit_reserved.fetchrow(reservation)
 
-        update_balance =    "UPDATE users " \
-                            "SET balance = balance + $1 " \
-                            "WHERE username = $2;"
+        state.remove_latest("buy")
 
-        await conn.execute(update_balance, selected["amount"], user_id)
-
-        delete_reserved =   "DELETE FROM reserved " \
-                            "WHERE reservationid = $1;"
+    if not selected:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "CANCEL_BUY",
+            "username": user_id,
+            "error_message": "No BUY to cancel" 
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
 
-        await conn.execute(delete_reserved, selected["reservationid"])
+        logger.info("No buy to cancel for %s", transaction_num)
+        return "No BUY to cancel" 
 
+    state.credit(selected["amount"])
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -491,7 +714,6 @@ async def cancel_buy(transaction_num, user_id, **settings):
 
 async def sell(transaction_num, user_id, stock_symbol, amount, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -533,58 +755,52 @@ async def sell(transaction_num, user_id, stock_symbol, amount, **settings):
 
     assert sell_quantity > 0
 
-    async with conn.transaction():
-
-        stock_check =   "SELECT stock_quantity FROM stocks " \
-                        "WHERE username = $1 " \
-                        "AND stock_symbol = $2 " \
-                        "AND stock_quantity >= $3;"
-
-        result = await conn.fetchrow(stock_check, user_id, stock_symbol, sell_quantity)
-
-        if not result:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "BUY",
-                "username": user_id,
-                "stock_symbol": stock_symbol,
-                "error_message": "Stock quantity insufficient to sell requested stock."
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("Funds insufficient to purchase requested stock for %s", transaction_num)
-            return "Stock quantity insufficient to sell requested stock."
-
-        sell_price = float(sell_quantity * price)
-
-        stocks_update = "UPDATE stocks " \
-                        "SET stock_quantity = stock_quantity - $1 " \
-                        "WHERE username = $2 " \
-                        "AND stock_symbol = $3;"
-
-        await conn.execute(stocks_update, sell_quantity, user_id, stock_symbol)
-
-        reserved_update =   "INSERT INTO reserved " \
-                            "(type, username, stock_symbol, stock_quantity, price, amount, timestamp) " \
-                            "VALUES " \
-                            "('sell', $1, $2, $3, $4, $5, $6);"
-                            
-        timestamp = round(loop.time()) + QUOTE_LIFESPAN # Expiry time.
-        await conn.execute(reserved_update, user_id, stock_symbol,
-                sell_quantity, price, sell_price, timestamp)
-
-        # Mark for expiry in QUOTE_LIFESPAN seconds.
-        await reservation_timestamp_queue.put(timestamp)
+    sell_price = float(sell_quantity * price)
+
+    state = await _user_state(settings)
+
+    # The cached holdings can rule the sale out without going to the database.
+    reservation = None
+    if state.holds(stock_symbol, sell_quantity):
+        async with _connection(settings) as conn:
+
+            reserve = conn.statement("sell")
+
+            timestamp = round(time.time()) + QUOTE_LIFESPAN # Expiry time.
+            reservation = await reserve.fetchval(user_id, stock_symbol, sell_quantity,
+                    price, sell_price, timestamp)
+
+        if not reservation:
+            # The cached holdings were out of date.
+            state.invalidate()
+
+    if not reservation:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "BUY",
+            "username": user_id,
+            "stock_symbol": stock_symbol,
+            "error_message": "Stock quantity insufficient to sell requested stock."
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("Funds insufficient to purchase requested stock for %s", transaction_num)
+        return "Stock quantity insufficient to sell requested stock."
+
+    # Mark for expiry in QUOTE_LIFESPAN seconds.
+    _expire_later(reservation, timestamp)
+
+    state.reserve("sell", reservation, timestamp)
+    state.add_stock(stock_symbol, -sell_quantity)
 
 async def commit_sell(transaction_num, user_id, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -599,37 +815,39 @@ async def commit_sell(transaction_num, user_id, **settings):
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    # Only the reservation found in memory is touched, so there is no need
+    # to go to the database if the user has nothing to commit.
+    state = await _user_state(settings)
+    reservation = state.latest("sell", round(time.time()))
 
-        selected = await _get_latest_reserved("sell", user_id, conn)
-        if not selected:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "COMMIT_SELL",
-                "username": user_id,
-                "error_message": "No SELL to commit" 
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
+    selected = None
+    if reservation:
+        async with _connection(settings) as conn:
 
-            logger.info("No sell to commit for %s", transaction_num)
-            return "No SELL to commit" 
+            credit_reserved = conn.statement("credit_reserved")
+            selected = await credit_reserved.fetchrow(reservation)
 
-        users_update =  "UPDATE users " \
-                        "SET balance = balance + $1 " \
-                        "WHERE username = $2;"
+        state.remove_latest("sell")
 
-        await conn.execute(users_update, selected["amount"], user_id)
+    if not selected:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "COMMIT_SELL",
+            "username": user_id,
+            "error_message": "No SELL to commit" 
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
 
-        delete_reserved =   "DELETE FROM reserved " \
-                            "WHERE reservationid = $1;"
+        logger.info("No sell to commit for %s", transaction_num)
+        return "No SELL to commit" 
 
-        await conn.execute(delete_reserved, selected["reservationid"])
+    state.credit(selected["amount"])
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -647,7 +865,6 @@ async def commit_sell(transaction_num, user_id, **settings):
 
 async def cancel_sell(transaction_num, user_id, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -662,44 +879,44 @@ async def cancel_sell(transaction_num, user_id, **settings):
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    # Only the reservation found in memory is touched, so there is no need
+    # to go to the database if the user has nothing to cancel.
+    state = await _user_state(settings)
+    reservation = state.latest("sell", round(time.time()))
 
-        selected = await _get_latest_reserved("sell", user_id, conn)
-        if not selected:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "CANCEL_SELL",
-                "username": user_id,
-                "error_message": "No SELL to cancel" 
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
+    selected = None
+    if reservation:
+        async with _connection(settings) as conn:
 
-            logger.info("No sell to cancel for %s", transaction_num)
-            return "No SELL to cancel" 
+            cancel = conn.statement("cancel_sell")
+            selected = await cancel.fetchrow(reservation)
 
-        stocks_update = "UPDATE stocks " \
-                        "SET stock_quantity = stock_quantity + $1 " \
-                        "WHERE username = $2 " \
-                        "AND stock_symbol = $3;"
+        state.remove_latest("sell")
 
-        await conn.execute(stocks_update, selected["stock_quantity"], user_id, selected["stock_symbol"])
+    if not selected:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "CANCEL_SELL",
+            "username": user_id,
+            "error_message": "No SELL to cancel" 
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
 
-        reservation_delete =    "DELETE FROM reserved " \
-                                "WHERE reservationid = $1;"
+        logger.info("No sell to cancel for %s", transaction_num)
+        return "No SELL to cancel" 
 
-        await conn.execute(reservation_delete, selected["reservationid"])
+    state.add_stock(selected["stock_symbol"], selected["stock_quantity"])
 
 # set_buy_amount allows a user to set a dollar amount of stock to buy.  This must be followed
 # by set_buy_trigger() before the trigger goes 'live'. 
 async def set_buy_amount(transaction_num, user_id, stock_symbol, amount, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -716,65 +933,43 @@ async def set_buy_amount(transaction_num, user_id, stock_symbol, amount, **setti
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    account = await _account(settings)
 
-        get_existing = "SELECT transaction_amount  " \
-                       "FROM triggers              " \
-                       "WHERE username = $1        " \
-                       "AND stock_symbol = $2      " \
-                       "AND type = 'buy';          "
+    # The cached account can rule this out without going to the database.
+    difference = None
+    if account.covers_buy_amount(stock_symbol, float(amount)):
+        async with _connection(settings) as conn:
 
-        # Does SET_BUY order exist for this user/stock combo?
-        existing = await conn.fetchval(get_existing, user_id, stock_symbol)
+            # If a SET_BUY order exists for this user/stock combo, only the difference from its
+            # amount is taken from the user, and the order is updated with the new BUY_AMOUNT.
+            # Otherwise a new order is created. Nothing is done if the user does not have the
+            # appropriate funds in their account.
+            set_amount = conn.statement("set_buy_amount")
+            difference = await set_amount.fetchval(user_id, stock_symbol, float(amount), int(transaction_num))
 
-        if existing:
-            difference = float(amount) - existing
-        else:
-            difference = float(amount)
-
-        # Confirm that the user has the appropriate funds in their account.
-        balance_check = "SELECT balance         " \
-                        "FROM users             " \
-                        "WHERE username = $1;   " \
-
-        balance = await conn.fetchval(balance_check, user_id)
-
-        if not balance or balance < difference:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "SET_BUY_AMOUNT",
-                "username": user_id,
-                "error_message": "Insufficient Funds" 
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-            return
-
-        logger.debug("Balance of %s: %.02f is sufficient for %s", user_id, balance, transaction_num)
-
-        users_update =  "UPDATE users               " \
-                        "SET balance = balance - $1 " \
-                        "WHERE username = $2        "
-
-        # Adjust member's account balance.
-        await conn.execute(users_update, difference, user_id)
-
-        # If the order existed already, update it with the new BUY_AMOUNT, else create new record.
-        triggers_update =   "INSERT INTO triggers                                                   " \
-                            "(username, stock_symbol, type, transaction_amount, transaction_number) " \
-                            "VALUES ($1, $2, 'buy', $3, $4)                                         " \
-                            "ON CONFLICT (username, stock_symbol, type) DO UPDATE                   " \
-                            "SET                                                                    " \
-                            "transaction_amount = $3,                                               " \
-                            "transaction_number = $4;                                               "
-
-        await conn.execute(triggers_update, user_id, stock_symbol, float(amount), int(transaction_num))
+        if difference is None:
+            # The cached account was out of date.
+            account.invalidate()
+
+    if difference is None:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_BUY_AMOUNT",
+            "username": user_id,
+            "error_message": "Insufficient Funds" 
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+        return
 
+    logger.debug("Balance of %s is sufficient for %s", user_id, transaction_num)
+    account.debit(difference)
+    account.set_trigger(stock_symbol, "buy", float(amount))
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -798,7 +993,6 @@ async def set_buy_amount(transaction_num, user_id, stock_symbol, amount, **setti
 
 async def cancel_set_buy(transaction_num, user_id, stock_symbol, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -814,50 +1008,45 @@ async def cancel_set_buy(transaction_num, user_id, stock_symbol, **settings):
     }
     await publisher.publish_message(json.dumps(message))
     
-    async with conn.transaction():
+    account = await _account(settings)
+
+    # The cached account can rule this out without going to the database.
+    refund_amount = None
+    if account.has_trigger(stock_symbol, "buy"):
+        async with _connection(settings) as conn:
 
-        get_existing = "SELECT transaction_amount  " \
-                       "FROM triggers              " \
-                       "WHERE username = $1        " \
-                       "AND stock_symbol = $2      " \
-                       "AND type = 'buy';          "
+            cancel = conn.statement("cancel_set_buy")
 
-        # Does SET_BUY order exist for this user/stock combo?
-        refund_amount = await conn.fetchval(get_existing, user_id, stock_symbol)
+            # Does SET_BUY order exist for this user/stock combo? If so, it is removed and refunded.
+            refund_amount = await cancel.fetchval(user_id, stock_symbol)
 
         if not refund_amount:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "CANCEL_SET_BUY",
-                "username": user_id,
-                "error_message": "SET_BUY does not exist, no action taken"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("SET_BUY does not exist, no action taken")
-            return "SET_BUY does not exist, no action taken"
-
-        logger.info("SET_BUY found, cancelling")
-        logger.debug("Refund amount for %s: %.02f", transaction_num, refund_amount)
-
-        users_update =  "UPDATE users               " \
-                        "SET balance = balance + $1 " \
-                        "WHERE username = $2        "
-
-        await conn.execute(users_update, refund_amount, user_id)
-
-        triggers_delete =   "DELETE FROM triggers   " \
-                            "WHERE username = $1    " \
-                            "AND stock_symbol = $2  " \
-                            "AND type = 'buy';      "
-
-        await conn.execute(triggers_delete, user_id, stock_symbol)
+            # The cached account was out of date.
+            account.invalidate()
+
+    if not refund_amount:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "CANCEL_SET_BUY",
+            "username": user_id,
+            "error_message": "SET_BUY does not exist, no action taken"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("SET_BUY does not exist, no action taken")
+        return "SET_BUY does not exist, no action taken"
+
+    logger.info("SET_BUY found, cancelling")
+    _remove_trigger(account, stock_symbol, "buy")
+    logger.debug("Refund amount for %s: %.02f", transaction_num, refund_amount)
+    account.credit(refund_amount)
+    account.remove_trigger(stock_symbol, "buy")
 
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -875,7 +1064,6 @@ async def cancel_set_buy(transaction_num, user_id, stock_symbol, **settings):
 
 async def set_buy_trigger(transaction_num, user_id, stock_symbol, amount, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -892,48 +1080,44 @@ async def set_buy_trigger(transaction_num, user_id, stock_symbol, amount, **sett
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    account = await _account(settings)
 
-        get_existing = "SELECT transaction_amount  " \
-                       "FROM triggers              " \
-                       "WHERE username = $1        " \
-                       "AND stock_symbol = $2      " \
-                       "AND type = 'buy';          "
+    # The cached account can rule this out without going to the database.
+    existing = None
+    if account.has_trigger(stock_symbol, "buy"):
+        async with _connection(settings) as conn:
 
-        # Does SET_BUY order exist for this user/stock combo?
-        existing = await conn.fetchval(get_existing, user_id, stock_symbol)
+            set_trigger = conn.statement("set_buy_trigger")
+
+            # Does SET_BUY order exist for this user/stock combo? If so, its trigger is set.
+            existing = await set_trigger.fetchval(user_id, stock_symbol, float(amount), int(transaction_num))
 
         if not existing:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "SET_BUY_TRIGGER",
-                "username": user_id,
-                "error_message": "SET_BUY does not exist, no action taken"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("SET_BUY does not exist, no action taken")
-            return "SET_BUY does not exist, no action taken"
-
-        triggers_update =   "UPDATE triggers             " \
-                            "SET                         " \
-                            "trigger_amount = $1,        " \
-                            "transaction_number = $2     " \
-                            "WHERE username = $3         " \
-                            "AND stock_symbol = $4       " \
-                            "AND type = 'buy';           "
-
-        await conn.execute(triggers_update, float(amount), int(transaction_num), user_id, stock_symbol)
+            # The cached account was out of date.
+            account.invalidate()
+
+    if not existing:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_BUY_TRIGGER",
+            "username": user_id,
+            "error_message": "SET_BUY does not exist, no action taken"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("SET_BUY does not exist, no action taken")
+        return "SET_BUY does not exist, no action taken"
+
+    _add_trigger(account, stock_symbol, "buy", float(amount), int(transaction_num))
 
 async def set_sell_amount(transaction_num, user_id, stock_symbol, requested_transaction, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -950,118 +1134,61 @@ async def set_sell_amount(transaction_num, user_id, stock_symbol, requested_tran
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
-
-        user_check =    "SELECT username " \
-                        "FROM users  " \
-                        "WHERE username = $1; "
-
-        exists = await conn.fetchval(user_check, user_id)
-        if not exists:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "SET_BUY_TRIGGER",
-                "username": user_id,
-                "error_message": "User for SET_SELL_AMOUNT does not exist"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-            return
-
-        # If a trigger already exists, we need to recalculate the required stock.
-        get_existing =  "SELECT transaction_amount, trigger_amount  " \
-                        "FROM triggers                              " \
-                        "WHERE username = $1                        " \
-                        "AND stock_symbol = $2                      " \
-                        "AND type = 'sell';                         "
-
-        existing = await conn.fetchrow(get_existing, user_id, stock_symbol)
-
-        if existing:
-
-            # This may be None if the trigger has not yet been set.
-            trigger_amount = existing["trigger_amount"]
-
-            if trigger_amount:
-                # Trigger has previously been set, so we must update the
-                # user's stocks.
-
-                current_transaction = existing["transaction_amount"]
-
-                # This is a sell, and therefore the trigger will only execute when
-                # the price is equal to or higher than the requested value. This
-                # means that the number of stock required will never be more than
-                # the division of the transaction amount by the trigger.
-                total_stock_required = int(float(requested_transaction) / trigger_amount)
-
-                # There were previously stocks subtracted from the user, so we
-                # must figure out how many extra we need to add/subtract.
-                previously_subtracted = int(current_transaction / trigger_amount)
-                difference = total_stock_required - previously_subtracted
-
-                # Check if user owns enough stock to carry out this transaction.
-                get_stock_quantity =    "SELECT stock_quantity " \
-                                        "FROM stocks           " \
-                                        "WHERE username = $1   " \
-                                        "AND stock_symbol = $2;"
-
-                stock_owned = await conn.fetchval(get_stock_quantity, user_id, stock_symbol)
-
-                # Difference may be negative, however this check will still pass.
-                if not stock_owned or stock_owned < difference:
-                    data = {
-                        "timestamp": int(time.time() * 1000),
-                        "server": "DDJK",
-                        "transaction_num": int(transaction_num),
-                        "command": "SET_SELL_AMOUNT",
-                        "username": user_id,
-                        "error_message": "User does not own enough shares of this type"
-                    }
-                    message = {
-                        "type": "errorEvent",
-                        "data": data
-                    }
-                    await publisher.publish_message(json.dumps(message))
-                    return
-
-                logger.info("User owns enough stocks for transaction %s to proceed.", transaction_num)
-
-                # Negative difference will result in an addition to the account here.
-                stocks_update = "UPDATE stocks                            " \
-                                "SET stock_quantity = stock_quantity - $1 " \
-                                "WHERE username = $2                      " \
-                                "AND stock_symbol = $3                    "
-
-                await conn.execute(stocks_update, difference, user_id, stock_symbol)
-
-            triggers_update =   "UPDATE triggers            " \
-                                "SET                        " \
-                                "transaction_amount = $1,   " \
-                                "transaction_number = $2    " \
-                                "WHERE username = $3        " \
-                                "AND stock_symbol = $4      " \
-                                "AND type = 'sell'          " \
-
-            await conn.execute(triggers_update, float(requested_transaction),
-                    int(transaction_num), user_id, stock_symbol)
-
-        else:
+    account = await _account(settings)
 
-            triggers_update =   "INSERT INTO triggers                                                   " \
-                                "(username, stock_symbol, type, transaction_amount, transaction_number) " \
-                                "VALUES ($1, $2, 'sell', $3, $4)                                        " \
+    # The cached account can rule this out without going to the database.
+    allowed = None
+    if account.exists():
+        async with _connection(settings) as conn:
 
-            await conn.execute(triggers_update, user_id, stock_symbol,
+            # If a trigger already exists, and its price has been set, the stock it requires is
+            # recalculated. The difference may be negative, in which case stock is returned.
+            set_amount = conn.statement("set_sell_amount")
+            allowed = await set_amount.fetchval(user_id, stock_symbol,
                     float(requested_transaction), int(transaction_num))
 
+        if allowed is None:
+            # The cached account was out of date.
+            account.invalidate()
+
+    if allowed is None:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_BUY_TRIGGER",
+            "username": user_id,
+            "error_message": "User for SET_SELL_AMOUNT does not exist"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+        return
+
+    if not allowed:
+        data = {
+            "timestamp": int(time.time() * 1000),
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_SELL_AMOUNT",
+            "username": user_id,
+            "error_message": "User does not own enough shares of this type"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+        return
+
+    # The stock held for the trigger may have changed, which is
+    # simpler to load again than to work out here.
+    account.invalidate()
+
 async def cancel_set_sell(transaction_num, user_id, stock_symbol, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -1077,63 +1204,49 @@ async def cancel_set_sell(transaction_num, user_id, stock_symbol, **settings):
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
+    account = await _account(settings)
+
+    # The cached account can rule this out without going to the database.
+    existing = None
+    if account.has_trigger(stock_symbol, "sell"):
+        async with _connection(settings) as conn:
 
-        get_existing = "SELECT transaction_amount, trigger_amount   " \
-                       "FROM triggers                               " \
-                       "WHERE username = $1                         " \
-                       "AND stock_symbol = $2                       " \
-                       "AND type = 'sell';                          "
+            cancel = conn.statement("cancel_set_sell")
 
-        # Does SET_SELL order exist for this user/stock combo?
-        existing = await conn.fetchrow(get_existing, user_id, stock_symbol)
+            # Does SET_SELL order exist for this user/stock combo? If so it is removed, and if
+            # its trigger was set, the stock that was subtracted from the user is refunded.
+            existing = await cancel.fetchval(user_id, stock_symbol)
 
         if not existing:
-            data = {
-                "timestamp": int(time.time() * 1000),
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "CANCEL_SET_SELL",
-                "username": user_id,
-                "error_message": "SET_SELL does not exist, no action taken"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("SET_SELL does not exist, no action taken")
-            return "SET_SELL does not exist, no action taken"
-
-        logger.info("SET_SELL found, cancelling")
-
-        trigger_amount = existing["trigger_amount"]
-
-        if trigger_amount:
-            # There is a trigger amount set, so funds were subtracted from
-            # the user's account, refund them.
-
-            transaction_amount = existing["transaction_amount"]
-            refund_amount = int(float(transaction_amount) / trigger_amount)
-                            
-            stocks_update = "UPDATE stocks                              " \
-                            "SET stock_quantity = stock_quantity + $1   " \
-                            "WHERE username = $2                        " \
-                            "AND stock_symbol = $3;                     "
-
-            await conn.execute(stocks_update, refund_amount, user_id, stock_symbol)
-
-        triggers_delete =   "DELETE FROM triggers   " \
-                            "WHERE username = $1    " \
-                            "AND stock_symbol = $2  " \
-                            "AND type = 'sell';      "
-
-        await conn.execute(triggers_delete, user_id, stock_symbol)
+            # The cached account was out of date.
+            account.invalidate()
+
+    if not existing:
+        data = {
+            "timestamp": int(time.time() * 1000),
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "CANCEL_SET_SELL",
+            "username": user_id,
+            "error_message": "SET_SELL does not exist, no action taken"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("SET_SELL does not exist, no action taken")
+        return "SET_SELL does not exist, no action taken"
+
+    logger.info("SET_SELL found, cancelled")
+    _remove_trigger(account, stock_symbol, "sell")
+
+    # Any stock held for the trigger was given back.
+    account.invalidate()
 
 async def set_sell_trigger(transaction_num, user_id, stock_symbol, requested_trigger, **settings):
     publisher = settings["publisher"]
-    conn = settings["conn"]
     
     data = {
         "timestamp": int(time.time() * 1000), 
@@ -1150,203 +1263,222 @@ async def set_sell_trigger(transaction_num, user_id, stock_symbol, requested_tri
     }
     await publisher.publish_message(json.dumps(message))
 
-    async with conn.transaction():
-    
-        get_existing =  "SELECT transaction_amount, trigger_amount  " \
-                        "FROM triggers                              " \
-                        "WHERE username = $1                        " \
-                        "AND stock_symbol = $2                      " \
-                        "AND type = 'sell';                         "
+    account = await _account(settings)
 
-        # Does SET_SELL order exist for this user/stock combo?
-        existing = await conn.fetchrow(get_existing, user_id, stock_symbol)
+    # The cached account can rule this out without going to the database.
+    allowed = None
+    if account.has_trigger(stock_symbol, "sell"):
+        async with _connection(settings) as conn:
 
-        if not existing:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "SET_SELL_TRIGGER",
-                "username": user_id,
-                "error_message": "SET_SELL does not exist, no action taken"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-
-            logger.info("SET_SELL does not exist, no action taken")
-            return "SET_SELL does not exist, no action taken"
-
-        # This may be None if the trigger has not yet been set.
-        current_trigger = existing["trigger_amount"]
-        transaction_amount = existing["transaction_amount"]
-
-        # This is a sell, and therefore the trigger will only execute when
-        # the price is equal to or higher than the requested value. This
-        # means that the number of stock required will never be more than
-        # the division of the transaction amount by the trigger.
-        total_stock_required = int(transaction_amount / float(requested_trigger))
-
-        if current_trigger:
-            # There were previously stocks subtracted from the user, so we
-            # must figure out how many extra we need to add/subtract.
-            previously_subtracted = int(transaction_amount / current_trigger)
-            difference = total_stock_required - previously_subtracted
-        else:
-            difference = total_stock_required
-
-        # Check if user owns enough stock to carry out this transaction.
-        get_stock_quantity =    "SELECT stock_quantity " \
-                                "FROM stocks           " \
-                                "WHERE username = $1   " \
-                                "AND stock_symbol = $2;"
-
-        stock_owned = await conn.fetchval(get_stock_quantity, user_id, stock_symbol)
-
-        # Difference may be negative, however this check will still pass.
-        if not stock_owned or stock_owned < difference:
-            data = {
-                "timestamp": int(time.time() * 1000), 
-                "server": "DDJK",
-                "transaction_num": int(transaction_num),
-                "command": "SET_SELL_TRIGGER",
-                "username": user_id,
-                "error_message": "User does not own enough shares of this type"
-            }
-            message = {
-                "type": "errorEvent",
-                "data": data
-            }
-            await publisher.publish_message(json.dumps(message))
-            return
-
-        logger.info("User owns enough stocks for transaction %s to proceed.", transaction_num)
-
-        # Negative difference will result in an addition to the account here.
-        stocks_update = " UPDATE stocks                            " \
-                        " SET stock_quantity = stock_quantity - $1 " \
-                        " WHERE username = $2                      " \
-                        " AND stock_symbol = $3                    "
-
-        await conn.execute(stocks_update, difference, user_id, stock_symbol)
-
-
-        triggers_update =   " UPDATE triggers                           " \
-                            " SET trigger_amount = $1,                  " \
-                            "     transaction_number = $2               " \
-                            " WHERE username = $3                       " \
-                            " AND stock_symbol = $4                     " \
-                            " AND type = 'sell';                        "
-
-        await conn.execute(triggers_update, float(requested_trigger), int(transaction_num), user_id, stock_symbol)
-
-async def _process_trigger(record, pool, publisher):
+            # This is a sell, and therefore the trigger will only execute when
+            # the price is equal to or higher than the requested value. This
+            # means that the number of stock required will never be more than
+            # the division of the transaction amount by the trigger. If the
+            # trigger was already set, only the difference is subtracted, and
+            # this may be negative.
+            set_trigger = conn.statement("set_sell_trigger")
+            allowed = await set_trigger.fetchval(user_id, stock_symbol,
+                    float(requested_trigger), int(transaction_num))
 
-    async with pool.acquire() as conn:
-        async with conn.transaction():
+        if allowed is None:
+            # The cached account was out of date.
+            account.invalidate()
+
+    if allowed is None:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_SELL_TRIGGER",
+            "username": user_id,
+            "error_message": "SET_SELL does not exist, no action taken"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+
+        logger.info("SET_SELL does not exist, no action taken")
+        return "SET_SELL does not exist, no action taken"
+
+    if not allowed:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": int(transaction_num),
+            "command": "SET_SELL_TRIGGER",
+            "username": user_id,
+            "error_message": "User does not own enough shares of this type"
+        }
+        message = {
+            "type": "errorEvent",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
+        return
 
-            # Check that the provided transaction still exists, as it is possible
-            # that it has been cancelled since the previous transaction.
-            trigger_check = "SELECT transaction_number FROM triggers " \
-                            "WHERE transaction_number = $1;          "
+    logger.info("User owns enough stocks for transaction %s to proceed.", transaction_num)
 
-            exists = await conn.fetchval(trigger_check, record["transaction_number"])
-            if not exists:
-                # Transaction has been cancelled,
-                # silently exit.
-                return
+    _add_trigger(account, stock_symbol, "sell", float(requested_trigger), int(transaction_num))
 
-            settings = {"publisher": publisher}
-            results = await quote(record["transaction_number"], record["username"], record["stock_symbol"], **settings)
-            price = results[0]
+    # The stock held for the trigger has changed.
+    account.invalidate()
 
-            trigger_amount = record["trigger_amount"]
-            transaction_amount = record["transaction_amount"]
+async def _quote_symbol(stock_symbol, username, transaction_number, publisher, semaphore):
+    # A single quote is enough to find every trigger on the stock that fires.
+    # The triggers are checked against it even if the quote was cached, as
+    # they may have been set since the price was first seen.
+    settings = {
+            "publisher": publisher,
+            "checks_triggers": True
+    }
+    async with semaphore:
+        results = await quote(transaction_number, username, stock_symbol, **settings)
+    return stock_symbol, results[0]
 
-            if record["type"] == "buy" and price <= trigger_amount:
-                # Buy has been "triggered"
+async def _fire_triggers(prices, pool, publisher):
+    """Helper function - carries out every trigger fired by the given prices, all together."""
 
-                stocks_update = "INSERT INTO stocks (username, stock_symbol, stock_quantity) " \
-                                "VALUES ($1, $2, $3) " \
-                                "ON CONFLICT (username, stock_symbol) DO UPDATE " \
-                                "SET stock_quantity = stocks.stock_quantity + $3 " \
-                                "WHERE stocks.username = $1 " \
-                                "AND stocks.stock_symbol = $2;"
+    fired = []
+    for stock_symbol, price in prices.items():
+        fired.extend((username, stock_symbol, trigger_type, price)
+                for username, trigger_type in trigger_book.fired(stock_symbol, price))
 
-                stock_quantity = int(transaction_amount / price)
-                await conn.execute(stocks_update, record["username"], record["stock_symbol"], stock_quantity)
+    logging.debug("%s triggers fired on %s stocks.", len(fired), len(prices))
+    if not fired:
+        return
 
-                balance_addition = transaction_amount - (price * stock_quantity)
+    # The statement checks each trigger again, as it may have been cancelled
+    # or changed since the book was checked. Only those carried out are returned.
+    async with pool.acquire() as conn:
+        execute_triggers = conn.statement("execute_triggers")
+        results = await execute_triggers.fetch(*[list(column) for column in zip(*fired)])
 
-            elif record["type"] == "sell" and price >= trigger_amount:
-                # Sell has been "triggered"
+        for record in results:
+            trigger_book.remove(record["username"], record["stock_symbol"], record["type"])
+        await _changed(conn, set(record["username"] for record in results))
 
-                num_stock = int(transaction_amount / trigger_amount)
-                balance_addition = num_stock * price
+    for record in results:
+        data = {
+            "timestamp": int(time.time() * 1000), 
+            "server": "DDJK",
+            "transaction_num": record["transaction_number"],
+            "action": "add", 
+            "username": record["username"],
+            "funds": float(record["balance_addition"])
+        }
+        message = {
+            "type": "accountTransaction",
+            "data": data
+        }
+        await publisher.publish_message(json.dumps(message))
 
-            else:
-                # We do not want to run the remainder
-                # of the code in this method.
-                return
+async def _load_triggers(pool):
+    async with pool.acquire() as conn:
+        get_live_triggers = conn.statement("get_live_triggers")
+        triggers = await get_live_triggers.fetch()
 
-            users_update =  "UPDATE users               " \
-                            "SET balance = balance + $1 " \
-                            "WHERE username = $2;       "
+    # Other workers, on this node or others, take care of the triggers of
+    # their own users.
+    trigger_book.clear()
+    for record in triggers:
+        if owns(record["username"]):
+            trigger_book.add(record["username"], record["stock_symbol"], record["type"],
+                    record["trigger_amount"], record["transaction_number"])
 
-            await conn.execute(users_update, balance_addition, record["username"])
+    logger.info("Loaded %s live triggers.", len(trigger_book))
 
-            triggers_update =   "DELETE FROM triggers   " \
-                                "WHERE username = $1    " \
-                                "AND stock_symbol = $2  " \
-                                "AND type = $3;         "
+async def _watch_prices(pool, publisher):
+    """Helper function - checks the triggers on a stock whenever any worker sees a new price for it."""
 
-            await conn.execute(triggers_update, record["username"], record["stock_symbol"], record["type"])
+    while True:
+        stock_symbol, price = await price_updates.get()
 
-    data = {
-        "timestamp": int(time.time() * 1000), 
-        "server": "DDJK",
-        "transaction_num": record["transaction_number"],
-        "action": "add", 
-        "username": record["username"],
-        "funds": float(balance_addition)
-    }
-    message = {
-        "type": "accountTransaction",
-        "data": data
-    }
-    await publisher.publish_message(json.dumps(message))
+        # Only the latest price of each stock matters, so any
+        # that queued up in the meantime are handled together.
+        prices = {stock_symbol: price}
+        while not price_updates.empty():
+            stock_symbol, price = price_updates.get_nowait()
+            prices[stock_symbol] = price
 
-async def trigger_maintainer(pool, publisher):
+        try:
+            await _fire_triggers(prices, pool, publisher)
+        except:
+            logger.exception("Checking triggers against new prices failed.")
+
+async def _broadcast_prices(pool):
+    """Helper function - passes the prices fetched here on to the other workers."""
 
     while True:
-        start_time = round(loop.time())
+        stock_symbol, price = await fresh_prices.get()
+
+        # Prices that queued up in the meantime are sent together, with
+        # only the latest of each stock.
+        prices = {stock_symbol: price}
+        while not fresh_prices.empty():
+            stock_symbol, price = fresh_prices.get_nowait()
+            prices[stock_symbol] = price
+
+        try:
+            async with pool.acquire() as conn:
+                notify_prices = conn.statement("notify_prices")
+                await notify_prices.fetch([json.dumps([SENDER, stock_symbol, price])
+                        for stock_symbol, price in prices.items()])
+        except:
+            logger.exception("Passing on new prices failed.")
 
-        async with pool.acquire() as conn:
-            async with conn.transaction():
+async def trigger_maintainer(pool, publisher):
 
-                get_triggers =  "SELECT * FROM triggers             " \
-                                "WHERE trigger_amount IS NOT NULL;  "
+    # The book is loaded once, and from then on is kept up to date by the
+    # commands that set and cancel triggers, and by the account listener.
+    await _load_triggers(pool)
+    loop.create_task(_watch_prices(pool, publisher))
+    loop.create_task(_broadcast_prices(pool))
 
-                triggers = await conn.fetch(get_triggers)
+    semaphore = asyncio.Semaphore(TRIGGER_CONCURRENCY, loop=loop)
+    slot_length = QUOTE_LIFESPAN / TRIGGER_SLOTS
 
-        # The list of triggers is no longer in a transaction, so we must be careful
-        # how we deal with them. Within each async task, we will check whether or
-        # not the trigger still exists in the context of the new transaction.
+    # Slots are scheduled from a fixed start, so that a slow slot does
+    # not push back every slot after it, and the sweep catches up.
+    start_time = loop.time()
+    slot = 0
 
-        logging.info("Trigger maintainer: %s triggers found to check.", len(triggers))
+    while True:
+        scheduled = start_time + slot * slot_length
+        sleep_time = scheduled - loop.time()
+        if sleep_time > 0:
+            await asyncio.sleep(sleep_time)
+
+        lag = loop.time() - scheduled
+        sweep_stats["last_lag"] = lag
+        sweep_stats["max_lag"] = max(sweep_stats["max_lag"], lag)
+
+        index = slot % TRIGGER_SLOTS
+        symbols = [entry for entry in trigger_book.symbols() if shard_for(entry[0], TRIGGER_SLOTS) == index]
+        logging.debug("Trigger maintainer: slot %s has %s stocks to check, %.03f seconds late.",
+                index, len(symbols), lag)
+
+        tasks = [_quote_symbol(stock_symbol, username, transaction_number, publisher, semaphore)
+                for stock_symbol, username, transaction_number in symbols]
+
+        # A stock whose quote failed is left out of this slot, and checked
+        # again the next time its slot comes around.
+        prices = dict()
+        for (stock_symbol, _, _), result in zip(symbols, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(result, Exception):
+                logger.error("Quoting %s for its triggers failed: %r", stock_symbol, result)
+            else:
+                prices[stock_symbol] = result[1]
 
-        tasks = [_process_trigger(record, pool, publisher) for record in triggers]
-        await asyncio.gather(*tasks)
+        try:
+            await _fire_triggers(prices, pool, publisher)
+        except:
+            logger.exception("Carrying out fired triggers failed.")
 
-        logging.debug("Finished processing triggers")
-        
-        now = round(loop.time())
-        sleep_time = QUOTE_LIFESPAN - (now - start_time)
-        logging.debug("Trigger maintainer sleeping for %s seconds.", sleep_time)
-        await asyncio.sleep(sleep_time)
-        logging.debug("Trigger maintainer woke up")
+        sweep_stats["slots"] += 1
+        sweep_stats["stocks_checked"] += len(symbols)
+        slot += 1
 
 async def dumplog(transaction_num, filename, **settings):
     publisher = settings["publisher"]
@@ -0,0 +1,47 @@
+import bisect
+import hashlib
+
+# The same ring as the router's, so that each node can tell which users the
+# router sends to it. The two must be kept in step.
+
+# Points placed on the ring for each node. More points spread users more
+# evenly between nodes, at the cost of a larger ring to search.
+REPLICAS = 100
+
+def _hash(key):
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+class HashRing(object):
+    """A consistent hash ring, mapping keys onto a set of nodes.
+
+    Adding or removing a node only moves the keys that belong to it, so most
+    users keep being served by the same node as the deployment changes.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = []
+        for node in nodes:
+            for replica in range(replicas):
+                points.append((_hash("{}#{}".format(node, replica)), node))
+        points.sort()
+
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self.nodes = list(nodes)
+
+    def candidates(self, key):
+        """Yield each node once, in order of preference for the key."""
+
+        if not self._nodes:
+            return
+
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(start + offset) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
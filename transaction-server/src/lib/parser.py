@@ -0,0 +1,84 @@
+from collections import namedtuple
+
+# A parsed transaction. The username is None for the DUMPLOG command that
+# applies to all users, and the remaining fields of the command are in args.
+Command = namedtuple("Command", ["transaction_num", "command", "username", "args"])
+
+_STOCK_CHARACTERS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+_FILENAME_PUNCTUATION = frozenset("_-. /")
+
+def _is_stock(field):
+    return 0 < len(field) <= 3 and _STOCK_CHARACTERS.issuperset(field)
+
+def _is_price(field):
+    # Digits, a decimal point, then exactly 2 digits.
+    point = len(field) - 3
+    return (point > 0
+            and field[point] == "."
+            and field[:point].isdecimal()
+            and field[point + 1:].isdecimal())
+
+def _is_filename(field):
+    return bool(field) and all(c.isalnum() or c in _FILENAME_PUNCTUATION for c in field)
+
+# The fields expected after the username, for each command.
+FIELDS = {
+        "QUOTE": (_is_stock,),
+        "ADD": (_is_price,),
+        "BUY": (_is_stock, _is_price),
+        "COMMIT_BUY": (),
+        "CANCEL_BUY": (),
+        "SELL": (_is_stock, _is_price),
+        "COMMIT_SELL": (),
+        "CANCEL_SELL": (),
+        "SET_BUY_AMOUNT": (_is_stock, _is_price),
+        "CANCEL_SET_BUY": (_is_stock,),
+        "SET_BUY_TRIGGER": (_is_stock, _is_price),
+        "SET_SELL_AMOUNT": (_is_stock, _is_price),
+        "CANCEL_SET_SELL": (_is_stock,),
+        "SET_SELL_TRIGGER": (_is_stock, _is_price),
+        "DUMPLOG": (_is_filename,),
+        "DISPLAY_SUMMARY": ()
+}
+
+def parse(transaction):
+    """Parse a transaction of the form '[n] COMMAND,username,...' in a single pass.
+
+    Returns a Command, or None if the transaction is not valid.
+    """
+
+    # A single trailing space (and new line) is allowed.
+    if transaction[-1:] == "\n":
+        transaction = transaction[:-1]
+    if transaction[-1:] == " ":
+        transaction = transaction[:-1]
+
+    fields = transaction.split(",")
+    number, _, command = fields[0].partition("] ")
+
+    validators = FIELDS.get(command)
+    if validators is None or number[:1] != "[":
+        return None
+
+    number = number[1:]
+    if not number.isdecimal():
+        return None
+
+    count = len(fields)
+    if count != len(validators) + 2:
+        if command == "DUMPLOG" and count == 2 and _is_filename(fields[1]):
+            # There is a derivation of DUMPLOG that does not contain
+            # a username, and applies to all users.
+            return Command(int(number), command, None, (fields[1],))
+        return None
+
+    username = fields[1]
+    if not username or " " in username:
+        return None
+
+    args = fields[2:]
+    for validator, field in zip(validators, args):
+        if not validator(field):
+            return None
+
+    return Command(int(number), command, username, tuple(args))
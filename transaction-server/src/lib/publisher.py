@@ -1,11 +1,31 @@
+import asyncio
 import logging
 import pika
+import queue
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+QUEUE_SIZE = 10000 # Messages buffered before publishers must wait.
+IDLE_INTERVAL = 1 # Seconds between servicing the connection while idle.
+BATCH_SIZE = 500 # Maximum messages sent to the broker as a single message.
+BATCH_LINGER = 0.005 # Seconds to wait for a batch to fill before sending it.
+
 class Publisher(object):
     def __init__(self):
+        # The pika connection is not thread safe, so it is owned entirely by
+        # the publisher thread. Messages are handed over through this queue,
+        # which means a slow broker never blocks the event loop.
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+        self._connect()
+
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        logger.debug("Finished init of Publisher")
+
+    def _connect(self):
         credentials = pika.credentials.PlainCredentials('admin','admin')
         self.connection = None
         while True:
@@ -20,10 +40,63 @@ class Publisher(object):
                 break
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue='logs')
-        logger.debug("Finished init of Publisher")
+
+    def _run(self):
+        while True:
+            try:
+                message = self.queue.get(timeout=IDLE_INTERVAL)
+            except queue.Empty:
+                # Nothing to publish, but the connection must still be
+                # serviced so that heartbeats are not missed.
+                try:
+                    self.connection.process_data_events()
+                except:
+                    logger.exception("Publisher connection lost while idle.")
+                    self._connect()
+                continue
+
+            self._publish(self._batch(message))
+
+    def _batch(self, first):
+        """Collect queued messages into a single JSON array, to save on per message overhead."""
+
+        batch = [first]
+        deadline = time.monotonic() + BATCH_LINGER
+
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Each message is already valid JSON, so there is
+        # no need to decode and encode them again.
+        return "[" + ",".join(batch) + "]"
+
+    def _publish(self, message):
+        while True:
+            try:
+                self.channel.basic_publish(exchange='',
+                                    routing_key='logs',
+                                    body=message)
+                return
+            except:
+                # Reconnect and try again, as the message
+                # would otherwise be lost.
+                logger.exception("Publishing failed, reconnecting.")
+                self._connect()
 
     async def publish_message(self,message):
-        logger.info("Publishing message %s", message)
-        self.channel.basic_publish(exchange='',
-                            routing_key='logs',
-                            body=message)
+        logger.debug("Publishing message %s", message)
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # The broker is falling behind. Wait for room in the queue without
+            # blocking the event loop, which slows down whoever is logging.
+            logger.warning("Publisher queue is full, waiting for room.")
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.queue.put, message)
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Time to wait for the quote server to respond before giving up on the
+# connection. A dead connection would otherwise hold a slot forever.
+RESPONSE_TIMEOUT = 5
+RESPONSE_CHUNK = 1024 # Bytes read from the quote server at a time.
+
+class QuotePool(object):
+    """A fixed size pool of persistent connections to the quote server.
+
+    Connections are opened lazily, and are health checked every time they
+    are taken from the pool. A connection that has been closed by the quote
+    server is transparently replaced with a new one, so callers never need
+    to know whether a request reused a connection or not.
+    """
+
+    def __init__(self, host, port, size, loop):
+        self.host = host
+        self.port = port
+        self.loop = loop
+
+        # Every slot starts out empty (None), and is only connected the
+        # first time it is used. The size of the queue bounds the number
+        # of concurrent requests to the quote server.
+        self._slots = asyncio.Queue(loop=loop)
+        for _ in range(size):
+            self._slots.put_nowait(None)
+
+    async def _connect(self):
+        logger.debug("Opening quote server connection to %s:%s.", self.host, self.port)
+        return await asyncio.open_connection(self.host, self.port, loop=self.loop)
+
+    def _healthy(self, connection):
+        if not connection:
+            return False
+
+        reader, writer = connection
+
+        # The quote server may have closed the connection since we last
+        # used it, in which case the EOF will already have been received.
+        return not reader.at_eof() and not writer.transport.is_closing()
+
+    def _close(self, connection):
+        if connection:
+            _, writer = connection
+            writer.close()
+
+    async def _receive(self, reader):
+        # A response ends with a newline, or when the quote server closes the
+        # connection, whichever comes first.
+        raw = b""
+        while b"\n" not in raw:
+            chunk = await reader.read(RESPONSE_CHUNK)
+            if not chunk:
+                break
+            raw += chunk
+        return raw
+
+    async def _send(self, connection, encoded):
+        reader, writer = connection
+        writer.write(encoded)
+        await writer.drain()
+        return await asyncio.wait_for(self._receive(reader), RESPONSE_TIMEOUT, loop=self.loop)
+
+    async def request(self, encoded):
+        """Send a single request to the quote server and return the raw response."""
+
+        connection = await self._slots.get()
+
+        try:
+            if not self._healthy(connection):
+                self._close(connection)
+                connection = await self._connect()
+
+            try:
+                raw = await self._send(connection, encoded)
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                raw = None
+
+            if not raw:
+                # The connection went stale between our health check and the
+                # request: the server either closed it, which is expected if
+                # it only allows one request per connection, or stopped
+                # answering on it. Either way, retry once on a new one.
+                logger.debug("Quote server connection went stale, reconnecting.")
+                self._close(connection)
+                connection = await self._connect()
+                raw = await self._send(connection, encoded)
+
+            if not raw:
+                raise ConnectionError("Quote server closed the connection without responding.")
+
+            return raw
+
+        except:
+            # We have no idea what state the connection is in,
+            # so it should never be used again.
+            self._close(connection)
+            connection = None
+            raise
+
+        finally:
+            self._slots.put_nowait(connection)
@@ -0,0 +1,37 @@
+from lib.hash_ring import HashRing
+
+import os
+import zlib
+
+# When run by the launcher, each process only serves the users that hash to
+# its own index. A standalone server is simply the only worker.
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", 1))
+
+# Behind the router, each node only serves the users that the router hashes
+# onto it. NODE is this node's entry in ROUTER_NODES, which must be the same
+# list that the router is given. Without them this is the only node.
+NODE = os.environ.get("NODE")
+NODES = [node.strip() for node in os.environ.get("ROUTER_NODES", "").split(",") if node.strip()]
+
+_ring = HashRing(NODES) if NODE and len(NODES) > 1 else None
+
+def shard_for(username, shards):
+    """Map a username onto one of a number of shards.
+
+    Python's hash() is randomized per process, so a CRC is used instead to
+    give the same answer in every process that routes users.
+    """
+
+    return zlib.crc32(username.encode("utf-8")) % shards
+
+def owns(username):
+    """Check whether a user is served by this worker process, when every node is up.
+
+    Another node only serves a user while the user's own node is unavailable.
+    """
+
+    if _ring and next(_ring.candidates(username)) != NODE:
+        return False
+
+    return shard_for(username, WORKER_COUNT) == WORKER_INDEX
@@ -0,0 +1,180 @@
+from lib.sharding import owns
+
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Every UserState that is in use, by username, so that the background tasks
+# can tell a user's worker when they change the user's account. The states
+# are held weakly, so that each goes away along with its worker.
+_states = weakref.WeakValueDictionary()
+
+def invalidate_account(username):
+    """Drop the cached account of a user, as something else has changed it."""
+
+    state = _states.get(username)
+    if state:
+        state.invalidate()
+
+def forget_user(username):
+    """Drop everything kept in memory about a user, as another worker has served them."""
+
+    state = _states.get(username)
+    if state:
+        state.forget()
+
+def forget_all():
+    for state in list(_states.values()):
+        state.forget()
+
+class UserState(object):
+    """What is kept in memory about a user, by the worker that processes their commands."""
+
+    def __init__(self, username):
+        self.username = username
+
+        # Whether this worker is the one that serves the user. Another worker
+        # only serves them while their own is unavailable, and does not keep
+        # anything about them that their own worker could change.
+        self.owned = owns(username)
+
+        # Reservations that may still be committed or cancelled, as stacks of
+        # (expiry time, reservationid) by type, with the latest on top. These
+        # are loaded from the database the first time they are needed, or
+        # every time if the user is not owned.
+        self.reservations = {
+                "buy": [],
+                "sell": []
+        }
+        self.loaded = False
+
+        # The user's account, only cached if enabled. A balance of None means
+        # that the user does not exist yet. Holdings map a stock symbol to the
+        # quantity held, and triggers map (stock symbol, type) to the amount.
+        self.balance = None
+        self.holdings = dict()
+        self.triggers = dict()
+        self.account_loaded = False
+
+        # Changed each time the account is invalidated, so that a load that
+        # was in progress at the time does not mark it (or the reservations)
+        # as loaded.
+        self.version = 0
+
+        _states[username] = self
+
+    async def load(self, conn, now):
+        """Load the reservations of this user that have not expired yet."""
+
+        version = self.version
+
+        get_user_reservations = conn.statement("get_user_reservations")
+        records = await get_user_reservations.fetch(self.username, now)
+
+        self.reservations = {
+                "buy": [],
+                "sell": []
+        }
+        for record in records:
+            self.reservations[record["type"]].append((record["timestamp"], record["reservationid"]))
+
+        self.loaded = self.version == version
+        logger.debug("Loaded reservations for %s.", self.username)
+
+    def reserve(self, reservation_type, reservation, expiry_time):
+        self.reservations[reservation_type].append((expiry_time, reservation))
+
+    def latest(self, reservation_type, now):
+        """Return the latest reservation of a type that has not expired, if any."""
+
+        # Every reservation expires the same time after it is made, so if the
+        # latest one has expired then so has every one below it.
+        stack = self.reservations[reservation_type]
+        if stack and stack[-1][0] > now:
+            return stack[-1][1]
+
+        stack.clear()
+        return None
+
+    def remove_latest(self, reservation_type):
+        self.reservations[reservation_type].pop()
+
+    async def load_account(self, conn):
+        """Load the user's balance, holdings and triggers into memory."""
+
+        version = self.version
+
+        get_account = conn.statement("get_account")
+        record = await get_account.fetchrow(self.username)
+
+        self.balance = record["balance"]
+        self.holdings = dict(zip(record["stock_symbols"], record["stock_quantities"]))
+        self.triggers = dict(zip(zip(record["trigger_symbols"], record["trigger_types"]),
+                record["trigger_amounts"]))
+        self.account_loaded = self.version == version
+        logger.debug("Loaded account for %s.", self.username)
+
+    def invalidate(self):
+        self.account_loaded = False
+        self.version += 1
+
+    def forget(self):
+        """Drop the account and reservations, so that both are loaded again when next used."""
+
+        self.invalidate()
+        self.loaded = False
+
+    # Each check below can only rule a command out. If the account is not
+    # cached then it passes, and the database has the final say.
+
+    def covers(self, amount):
+        if not self.account_loaded:
+            return True
+        return self.balance is not None and self.balance >= amount
+
+    def holds(self, stock_symbol, quantity):
+        if not self.account_loaded:
+            return True
+        return self.holdings.get(stock_symbol, 0) >= quantity
+
+    def has_trigger(self, stock_symbol, trigger_type):
+        if not self.account_loaded:
+            return True
+        return (stock_symbol, trigger_type) in self.triggers
+
+    def covers_buy_amount(self, stock_symbol, amount):
+        if not self.account_loaded:
+            return True
+        # Only the change from an existing buy trigger is taken from the
+        # balance, and an empty balance is never enough.
+        difference = amount - self.triggers.get((stock_symbol, "buy"), 0)
+        return bool(self.balance) and self.balance >= difference
+
+    def exists(self):
+        if not self.account_loaded:
+            return True
+        return self.balance is not None
+
+    # Each change below is made after the same change has been written to
+    # the database, and does nothing if the account is not cached.
+
+    def credit(self, amount):
+        if self.account_loaded:
+            self.balance = amount if self.balance is None else self.balance + amount
+
+    def debit(self, amount):
+        if self.account_loaded:
+            self.balance -= amount
+
+    def add_stock(self, stock_symbol, quantity):
+        if self.account_loaded:
+            self.holdings[stock_symbol] = self.holdings.get(stock_symbol, 0) + quantity
+
+    def set_trigger(self, stock_symbol, trigger_type, amount):
+        if self.account_loaded:
+            self.triggers[(stock_symbol, trigger_type)] = amount
+
+    def remove_trigger(self, stock_symbol, trigger_type):
+        if self.account_loaded:
+            self.triggers.pop((stock_symbol, trigger_type), None)
@@ -0,0 +1,445 @@
+import asyncpg
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every statement run by the commands, by name. Each is prepared once on every
+# connection as it is opened, so that a command never has to wait for postgres
+# to parse and plan its SQL.
+STATEMENTS = {
+        "add_funds":            "INSERT INTO users (username, balance) " \
+                                "VALUES ($1, $2) " \
+                                "ON CONFLICT (username) DO UPDATE " \
+                                "SET balance = users.balance + $2 " \
+                                "WHERE users.username = $1;",
+
+        # The commands below each do all of their work in a single statement,
+        # so that only one round trip is made to the database per command.
+        # Each returns nothing (or false) if the command could not be done.
+
+        # Takes the funds for a purchase, and reserves it. Returns the
+        # reservation, or nothing if the user does not have the funds.
+        "buy":                  "WITH debit AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = balance - $3 " \
+                                    "WHERE username = $1 " \
+                                    "AND balance >= $3 " \
+                                    "RETURNING username " \
+                                "), reservation AS ( " \
+                                    "INSERT INTO reserved " \
+                                    "(type, username, stock_symbol, stock_quantity, price, amount, timestamp) " \
+                                    "SELECT 'buy', username, $2::varchar, $4::int, $5::float, $3::float, $6::float " \
+                                    "FROM debit " \
+                                    "RETURNING reservationid " \
+                                ") " \
+                                "SELECT reservationid FROM reservation;",
+
+        # Takes the stock for a sale, and reserves it. Returns the
+        # reservation, or nothing if the user does not have the stock.
+        "sell":                 "WITH debit AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stock_quantity - $3 " \
+                                    "WHERE username = $1 " \
+                                    "AND stock_symbol = $2 " \
+                                    "AND stock_quantity >= $3 " \
+                                    "RETURNING username " \
+                                "), reservation AS ( " \
+                                    "INSERT INTO reserved " \
+                                    "(type, username, stock_symbol, stock_quantity, price, amount, timestamp) " \
+                                    "SELECT 'sell', username, $2::varchar, $3::int, $4::float, $5::float, $6::float " \
+                                    "FROM debit " \
+                                    "RETURNING reservationid " \
+                                ") " \
+                                "SELECT reservationid FROM reservation;",
+
+        # Removes a buy reservation, and gives the user its stock.
+        "commit_buy":           "WITH removed AS ( " \
+                                    "DELETE FROM reserved " \
+                                    "WHERE reservationid = $1 " \
+                                    "RETURNING username, stock_symbol, stock_quantity, amount " \
+                                "), credit AS ( " \
+                                    "INSERT INTO stocks (username, stock_symbol, stock_quantity) " \
+                                    "SELECT username, stock_symbol, stock_quantity FROM removed " \
+                                    "ON CONFLICT (username, stock_symbol) DO UPDATE " \
+                                    "SET stock_quantity = stocks.stock_quantity + EXCLUDED.stock_quantity " \
+                                ") " \
+                                "SELECT stock_symbol, stock_quantity, amount FROM removed;",
+
+        # Removes a sell reservation, and returns its stock to the user.
+        "cancel_sell":          "WITH removed AS ( " \
+                                    "DELETE FROM reserved " \
+                                    "WHERE reservationid = $1 " \
+                                    "RETURNING username, stock_symbol, stock_quantity, amount " \
+                                "), credit AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stocks.stock_quantity + removed.stock_quantity " \
+                                    "FROM removed " \
+                                    "WHERE stocks.username = removed.username " \
+                                    "AND stocks.stock_symbol = removed.stock_symbol " \
+                                ") " \
+                                "SELECT stock_symbol, stock_quantity, amount FROM removed;",
+
+        # Removes a reservation, and credits the user with its amount. This
+        # cancels a buy, or commits a sell.
+        "credit_reserved":      "WITH removed AS ( " \
+                                    "DELETE FROM reserved " \
+                                    "WHERE reservationid = $1 " \
+                                    "RETURNING username, stock_symbol, stock_quantity, amount " \
+                                "), credit AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = users.balance + removed.amount " \
+                                    "FROM removed " \
+                                    "WHERE users.username = removed.username " \
+                                ") " \
+                                "SELECT stock_symbol, stock_quantity, amount FROM removed;",
+
+        # Sets the amount of a buy trigger, taking (or refunding) the change
+        # from the user's balance. Returns the change, or nothing if the user
+        # does not have the funds.
+        "set_buy_amount":       "WITH existing AS ( " \
+                                    "SELECT $3 - COALESCE(SUM(transaction_amount), 0) AS difference " \
+                                    "FROM triggers " \
+                                    "WHERE username = $1 " \
+                                    "AND stock_symbol = $2 " \
+                                    "AND type = 'buy' " \
+                                "), debit AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = balance - existing.difference " \
+                                    "FROM existing " \
+                                    "WHERE username = $1 " \
+                                    "AND balance <> 0 " \
+                                    "AND balance >= existing.difference " \
+                                    "RETURNING existing.difference " \
+                                "), upsert AS ( " \
+                                    "INSERT INTO triggers " \
+                                    "(username, stock_symbol, type, transaction_amount, transaction_number) " \
+                                    "SELECT $1, $2, 'buy', $3, $4::int FROM debit " \
+                                    "ON CONFLICT (username, stock_symbol, type) DO UPDATE " \
+                                    "SET " \
+                                    "transaction_amount = $3, " \
+                                    "transaction_number = $4 " \
+                                ") " \
+                                "SELECT difference FROM debit;",
+
+        # Removes a buy trigger, refunding its amount. Returns the refund, or
+        # nothing if there is no trigger. A trigger with no amount is treated
+        # as if there were none, and left alone.
+        "cancel_set_buy":       "WITH removed AS ( " \
+                                    "DELETE FROM triggers " \
+                                    "WHERE username = $1 " \
+                                    "AND stock_symbol = $2 " \
+                                    "AND type = 'buy' " \
+                                    "AND transaction_amount <> 0 " \
+                                    "RETURNING username, transaction_amount " \
+                                "), credit AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = users.balance + removed.transaction_amount " \
+                                    "FROM removed " \
+                                    "WHERE users.username = removed.username " \
+                                ") " \
+                                "SELECT transaction_amount FROM removed;",
+
+        # Returns the amount of the buy trigger, or nothing if there isn't one.
+        # As above, a trigger with no amount is left alone.
+        "set_buy_trigger":      "UPDATE triggers " \
+                                "SET " \
+                                "trigger_amount = $3, " \
+                                "transaction_number = $4 " \
+                                "WHERE username = $1 " \
+                                "AND stock_symbol = $2 " \
+                                "AND type = 'buy' " \
+                                "AND transaction_amount <> 0 " \
+                                "RETURNING transaction_amount;",
+
+        # Sets the amount of a sell trigger. If the trigger price is already
+        # set, the change in stock required is taken (or refunded) from the
+        # user. Returns nothing if the user does not exist, and false if the
+        # user does not own enough stock.
+        "set_sell_amount":      "WITH existing AS ( " \
+                                    "SELECT transaction_amount, NULLIF(trigger_amount, 0) AS trigger_amount " \
+                                    "FROM triggers " \
+                                    "WHERE username = $1 " \
+                                    "AND stock_symbol = $2 " \
+                                    "AND type = 'sell' " \
+                                "), required AS ( " \
+                                    "SELECT users.username, stocks.stock_quantity, " \
+                                    "existing.transaction_amount IS NOT NULL AS existed, " \
+                                    "trunc($3 / existing.trigger_amount)::int " \
+                                        "- trunc(existing.transaction_amount / existing.trigger_amount)::int AS difference " \
+                                    "FROM users " \
+                                    "LEFT JOIN existing ON TRUE " \
+                                    "LEFT JOIN stocks ON stocks.username = users.username " \
+                                    "AND stocks.stock_symbol = $2 " \
+                                    "WHERE users.username = $1 " \
+                                "), outcome AS ( " \
+                                    "SELECT username, existed, difference, " \
+                                    "difference IS NULL " \
+                                        "OR (COALESCE(stock_quantity, 0) <> 0 AND stock_quantity >= difference) AS allowed " \
+                                    "FROM required " \
+                                "), debit AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stock_quantity - outcome.difference " \
+                                    "FROM outcome " \
+                                    "WHERE stocks.username = outcome.username " \
+                                    "AND stocks.stock_symbol = $2 " \
+                                    "AND outcome.allowed " \
+                                    "AND outcome.difference IS NOT NULL " \
+                                "), updated AS ( " \
+                                    "UPDATE triggers " \
+                                    "SET " \
+                                    "transaction_amount = $3, " \
+                                    "transaction_number = $4 " \
+                                    "FROM outcome " \
+                                    "WHERE triggers.username = outcome.username " \
+                                    "AND triggers.stock_symbol = $2 " \
+                                    "AND triggers.type = 'sell' " \
+                                    "AND outcome.allowed " \
+                                "), created AS ( " \
+                                    "INSERT INTO triggers " \
+                                    "(username, stock_symbol, type, transaction_amount, transaction_number) " \
+                                    "SELECT username, $2, 'sell', $3, $4::int FROM outcome " \
+                                    "WHERE NOT existed " \
+                                ") " \
+                                "SELECT allowed FROM outcome;",
+
+        # Removes a sell trigger, returning any stock taken for it to the user.
+        # Returns nothing if there was no trigger.
+        "cancel_set_sell":      "WITH removed AS ( " \
+                                    "DELETE FROM triggers " \
+                                    "WHERE username = $1 " \
+                                    "AND stock_symbol = $2 " \
+                                    "AND type = 'sell' " \
+                                    "RETURNING username, stock_symbol, " \
+                                    "trunc(transaction_amount / NULLIF(trigger_amount, 0))::int AS refund " \
+                                "), credit AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stocks.stock_quantity + removed.refund " \
+                                    "FROM removed " \
+                                    "WHERE stocks.username = removed.username " \
+                                    "AND stocks.stock_symbol = removed.stock_symbol " \
+                                    "AND removed.refund IS NOT NULL " \
+                                ") " \
+                                "SELECT username FROM removed;",
+
+        # Sets the price of a sell trigger, taking (or refunding) the change in
+        # stock required from the user. Returns nothing if there is no trigger,
+        # and false if the user does not own enough stock.
+        "set_sell_trigger":     "WITH required AS ( " \
+                                    "SELECT triggers.username, stocks.stock_quantity, " \
+                                    "trunc(triggers.transaction_amount / $3)::int " \
+                                        "- COALESCE(trunc(triggers.transaction_amount / NULLIF(triggers.trigger_amount, 0))::int, 0) AS difference " \
+                                    "FROM triggers " \
+                                    "LEFT JOIN stocks ON stocks.username = triggers.username " \
+                                    "AND stocks.stock_symbol = triggers.stock_symbol " \
+                                    "WHERE triggers.username = $1 " \
+                                    "AND triggers.stock_symbol = $2 " \
+                                    "AND triggers.type = 'sell' " \
+                                "), allowed AS ( " \
+                                    "SELECT username, difference FROM required " \
+                                    "WHERE COALESCE(stock_quantity, 0) <> 0 " \
+                                    "AND stock_quantity >= difference " \
+                                "), debit AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stock_quantity - allowed.difference " \
+                                    "FROM allowed " \
+                                    "WHERE stocks.username = allowed.username " \
+                                    "AND stocks.stock_symbol = $2 " \
+                                "), updated AS ( " \
+                                    "UPDATE triggers " \
+                                    "SET " \
+                                    "trigger_amount = $3, " \
+                                    "transaction_number = $4 " \
+                                    "FROM allowed " \
+                                    "WHERE triggers.username = allowed.username " \
+                                    "AND triggers.stock_symbol = $2 " \
+                                    "AND triggers.type = 'sell' " \
+                                ") " \
+                                "SELECT allowed.username IS NOT NULL " \
+                                "FROM required LEFT JOIN allowed ON TRUE;",
+
+        "get_reservations":     "SELECT reservationid, username, timestamp FROM reserved;",
+
+        "get_user_reservations": "SELECT reservationid, type, timestamp FROM reserved " \
+                                "WHERE username = $1 " \
+                                "AND timestamp > $2 " \
+                                "ORDER BY timestamp, reservationid;",
+
+        # Removes a batch of expired reservations, giving back the funds held
+        # by each buy and the stock held by each sell. Returns the user of each
+        # reservation removed, as some may have been committed or cancelled.
+        "expire_reserved":      "WITH expired AS ( " \
+                                    "DELETE FROM reserved " \
+                                    "WHERE reservationid = ANY($1::int[]) " \
+                                    "RETURNING type, username, stock_symbol, stock_quantity, amount " \
+                                "), funds AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = balance + refund.amount " \
+                                    "FROM ( " \
+                                        "SELECT username, SUM(amount) AS amount FROM expired " \
+                                        "WHERE type = 'buy' " \
+                                        "GROUP BY username " \
+                                    ") AS refund " \
+                                    "WHERE users.username = refund.username " \
+                                "), shares AS ( " \
+                                    "UPDATE stocks " \
+                                    "SET stock_quantity = stocks.stock_quantity + refund.stock_quantity " \
+                                    "FROM ( " \
+                                        "SELECT username, stock_symbol, SUM(stock_quantity) AS stock_quantity FROM expired " \
+                                        "WHERE type = 'sell' " \
+                                        "GROUP BY username, stock_symbol " \
+                                    ") AS refund " \
+                                    "WHERE stocks.username = refund.username " \
+                                    "AND stocks.stock_symbol = refund.stock_symbol " \
+                                ") " \
+                                "SELECT username FROM expired;",
+
+        # Everything cached about a user's account, in a single row.
+        "get_account":          "SELECT " \
+                                "(SELECT balance FROM users WHERE username = $1) AS balance, " \
+                                "ARRAY(SELECT stock_symbol FROM stocks WHERE username = $1 " \
+                                    "ORDER BY stock_symbol) AS stock_symbols, " \
+                                "ARRAY(SELECT stock_quantity FROM stocks WHERE username = $1 " \
+                                    "ORDER BY stock_symbol) AS stock_quantities, " \
+                                "ARRAY(SELECT stock_symbol FROM triggers WHERE username = $1 " \
+                                    "ORDER BY stock_symbol, type) AS trigger_symbols, " \
+                                "ARRAY(SELECT type FROM triggers WHERE username = $1 " \
+                                    "ORDER BY stock_symbol, type) AS trigger_types, " \
+                                "ARRAY(SELECT transaction_amount FROM triggers WHERE username = $1 " \
+                                    "ORDER BY stock_symbol, type) AS trigger_amounts;",
+
+        "get_live_triggers":    "SELECT * FROM triggers " \
+                                "WHERE trigger_amount IS NOT NULL;",
+
+        "get_user_triggers":    "SELECT * FROM triggers " \
+                                "WHERE username = $1 " \
+                                "AND trigger_amount IS NOT NULL;",
+
+        # Tells every worker that the accounts of these users have changed.
+        "notify_accounts":      "SELECT pg_notify('accounts', username) " \
+                                "FROM unnest($1::varchar[]) AS username;",
+
+        # Tells every worker the prices that this one has fetched, each given
+        # as a JSON payload of [sender, stock symbol, price].
+        "notify_prices":        "SELECT pg_notify('prices', payload) " \
+                                "FROM unnest($1::text[]) AS payload;",
+
+        # Carries out a batch of fired triggers, given as arrays of username,
+        # stock symbol, type and the price that fired each. A buy gets as much
+        # stock as its amount pays for, and is credited the rest. A sell is
+        # credited for the stock taken when its trigger was set. Triggers that
+        # no longer fire at their price are left alone. Returns the outcome of
+        # each trigger carried out.
+        "execute_triggers":     "WITH fired AS ( " \
+                                    "DELETE FROM triggers " \
+                                    "USING unnest($1::varchar[], $2::varchar[], $3::varchar[], $4::float[]) " \
+                                    "AS batch (username, stock_symbol, type, price) " \
+                                    "WHERE triggers.username = batch.username " \
+                                    "AND triggers.stock_symbol = batch.stock_symbol " \
+                                    "AND triggers.type = batch.type " \
+                                    "AND batch.price > 0 " \
+                                    "AND ( " \
+                                        "(batch.type = 'buy' AND batch.price <= triggers.trigger_amount) " \
+                                        "OR (batch.type = 'sell' AND batch.price >= triggers.trigger_amount AND triggers.trigger_amount > 0) " \
+                                    ") " \
+                                    "RETURNING triggers.*, batch.price " \
+                                "), outcome AS ( " \
+                                    "SELECT username, stock_symbol, type, transaction_number, " \
+                                    "trunc(transaction_amount / price)::int AS stock_quantity, " \
+                                    "transaction_amount - (price * trunc(transaction_amount / price)) AS balance_addition " \
+                                    "FROM fired WHERE type = 'buy' " \
+                                    "UNION ALL " \
+                                    "SELECT username, stock_symbol, type, transaction_number, " \
+                                    "0 AS stock_quantity, " \
+                                    "trunc(transaction_amount / trigger_amount) * price AS balance_addition " \
+                                    "FROM fired WHERE type = 'sell' " \
+                                "), credit_stock AS ( " \
+                                    "INSERT INTO stocks (username, stock_symbol, stock_quantity) " \
+                                    "SELECT username, stock_symbol, stock_quantity FROM outcome " \
+                                    "WHERE type = 'buy' " \
+                                    "ON CONFLICT (username, stock_symbol) DO UPDATE " \
+                                    "SET stock_quantity = stocks.stock_quantity + EXCLUDED.stock_quantity " \
+                                "), credit_balance AS ( " \
+                                    "UPDATE users " \
+                                    "SET balance = users.balance + total.balance_addition " \
+                                    "FROM ( " \
+                                        "SELECT username, SUM(balance_addition) AS balance_addition FROM outcome " \
+                                        "GROUP BY username " \
+                                    ") AS total " \
+                                    "WHERE users.username = total.username " \
+                                ") " \
+                                "SELECT username, stock_symbol, type, transaction_number, balance_addition FROM outcome;"
+}
+
+# How many statements asyncpg keeps prepared on each connection. This is never
+# less than asyncpg's own default, and leaves room for every registered
+# statement as well as the other queries run on the connection.
+CACHE_SIZE = max(100, 2 * len(STATEMENTS))
+
+# Seconds a prepared statement is kept in the cache of a connection. None of
+# them go stale, so they are kept for as long as the connection is open.
+CACHE_LIFETIME = 0
+
+# Statements prepared as connections were opened, runs that found their
+# statement still prepared on the connection, and runs that had to prepare
+# theirs again because it had been dropped from the cache. These are read from
+# the cache itself, so a statement dropped from it is never counted as reused.
+stats = {
+        "prepared": 0,
+        "reused": 0,
+        "reprepared": 0
+}
+
+class Statement(object):
+    """A registered statement, run through the statement cache of a connection."""
+
+    def __init__(self, conn, query):
+        self.conn = conn
+        self.query = query
+
+    async def fetch(self, *args):
+        return await self.conn.fetch(self.query, *args)
+
+    async def fetchrow(self, *args):
+        return await self.conn.fetchrow(self.query, *args)
+
+    async def fetchval(self, *args):
+        return await self.conn.fetchval(self.query, *args)
+
+class StatementConnection(asyncpg.Connection):
+    """A connection that keeps every registered statement prepared."""
+
+    def _cached(self, query):
+        # asyncpg has no public way to look into the cache. Its entries are
+        # keyed by the query, the record class (left as the default by the
+        # pool) and whether custom codecs are ignored.
+        return self._stmt_cache.has((query, asyncpg.Record, False))
+
+    def statement(self, name):
+        """Return a registered statement to run on this connection."""
+
+        # Handles from prepare() stop working once the connection goes back to
+        # the pool, so the prepared statements are kept in the cache of the
+        # connection instead, and each is run by its query.
+        query = STATEMENTS[name]
+        if self._cached(query):
+            stats["reused"] += 1
+        else:
+            stats["reprepared"] += 1
+
+        return Statement(self, query)
+
+async def prepare_all(conn):
+    """Pool init hook - prepares every registered statement on a new connection."""
+
+    # Running a statement for no arguments prepares it in the cache of the
+    # connection without executing it.
+    for query in STATEMENTS.values():
+        await conn.executemany(query, [])
+
+    # Preparing opens an implicit transaction that asyncpg leaves open, which
+    # would hold locks on the tables of the statements until the connection
+    # was first used. Any other query ends it.
+    await conn.execute("SELECT 1;")
+
+    stats["prepared"] += len(STATEMENTS)
+    logger.debug("Prepared %s statements on new connection.", len(STATEMENTS))
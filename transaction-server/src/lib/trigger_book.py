@@ -0,0 +1,80 @@
+import bisect
+
+class TriggerBook(object):
+    """The live triggers of each stock, sorted by the price that they trigger at.
+
+    Each stock has a buy side and a sell side, both kept in the order in which
+    their triggers fire, so that the triggers fired by a price are always a
+    range at the end of a side. A buy fires when the price falls to its
+    trigger, so buys are sorted by trigger. A sell fires when the price rises
+    to its trigger, so sells are sorted by the negated trigger.
+    """
+
+    def __init__(self):
+        # Maps a stock symbol to its sides, each a sorted list of (key, username).
+        self.sides = dict()
+
+        # Maps (username, stock symbol, type) to (trigger, transaction number).
+        self.triggers = dict()
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def _key(self, trigger_type, trigger_amount):
+        return trigger_amount if trigger_type == "buy" else -trigger_amount
+
+    def add(self, username, stock_symbol, trigger_type, trigger_amount, transaction_number):
+        """Add a trigger, replacing any that the user has of the same type on the stock."""
+
+        self.remove(username, stock_symbol, trigger_type)
+
+        sides = self.sides.setdefault(stock_symbol, {"buy": [], "sell": []})
+        bisect.insort(sides[trigger_type], (self._key(trigger_type, trigger_amount), username))
+        self.triggers[(username, stock_symbol, trigger_type)] = (trigger_amount, transaction_number)
+
+    def remove(self, username, stock_symbol, trigger_type):
+        existing = self.triggers.pop((username, stock_symbol, trigger_type), None)
+        if not existing:
+            return
+
+        sides = self.sides[stock_symbol]
+        side = sides[trigger_type]
+        entry = (self._key(trigger_type, existing[0]), username)
+        del side[bisect.bisect_left(side, entry)]
+
+        if not sides["buy"] and not sides["sell"]:
+            del self.sides[stock_symbol]
+
+    def remove_user(self, username):
+        for _, stock_symbol, trigger_type in [key for key in self.triggers if key[0] == username]:
+            self.remove(username, stock_symbol, trigger_type)
+
+    def clear(self):
+        self.sides.clear()
+        self.triggers.clear()
+
+    def symbols(self):
+        """List the stocks that have triggers, with one of their triggers to quote them for."""
+
+        result = []
+        for stock_symbol, sides in self.sides.items():
+            trigger_type = "buy" if sides["buy"] else "sell"
+            username = sides[trigger_type][0][1]
+            _, transaction_number = self.triggers[(username, stock_symbol, trigger_type)]
+            result.append((stock_symbol, username, transaction_number))
+
+        return result
+
+    def fired(self, stock_symbol, price):
+        """List the (username, type) of each trigger on a stock fired by a price."""
+
+        sides = self.sides.get(stock_symbol)
+        if not sides:
+            return []
+
+        result = []
+        for trigger_type, side in sides.items():
+            start = bisect.bisect_left(side, (self._key(trigger_type, price),))
+            result.extend((username, trigger_type) for _, username in side[start:])
+
+        return result
@@ -1,7 +1,12 @@
 import lib.commands as commands
+import lib.parser as parser
+import lib.statements as statements
 from lib.publisher import Publisher
+from lib.state import UserState
+from lib.sharding import shard_for, WORKER_INDEX, WORKER_COUNT
 
 from quart import Quart, request, jsonify
+from collections import OrderedDict
 import asyncpg
 import asyncio
 import asyncio
@@ -19,44 +24,39 @@ DB = DB_USER = DB_HOST = "postgres"
 DB_PASSWORD = "supersecure"
 DB_PORT = 5432
 
-CONN_MIN = 100
-CONN_MAX = 1000
+# The launcher splits these between its workers.
+CONN_MIN = int(os.environ.get("CONN_MIN", 100))
+CONN_MAX = int(os.environ.get("CONN_MAX", 1000))
 
+PORT = int(os.environ.get("PORT", 5000))
 
-R_START = r"^"
-R_TRANS_NUM = r"^\[(\d+)\] "
-R_END = r" ?$"
-def build_regex(*args):
-    center = ",".join(args)
-    return re.compile(R_START + R_TRANS_NUM + center + R_END)
+USER_IDLE_TIMEOUT = 300 # Seconds a user's worker waits for work before exiting.
+
+# When set, users are hashed onto this many executors, each of which owns a
+# long lived DB connection, rather than each active user having a worker.
+EXECUTOR_SHARDS = int(os.environ.get("EXECUTOR_SHARDS", 0))
+EXECUTOR_RESERVE = 10 # Connections left for background tasks in executor mode.
 
-R_STOCK = r"([A-Z]{1,3})"
-R_PRICE = r"(\d+\.\d{2})"
-R_USERNAME = r"([^ ]+)"
-R_FILENAME = r"([\w\-. /]+)"
 
 PROCESSORS = {
-        "QUOTE": (commands.quote, build_regex("QUOTE", R_USERNAME, R_STOCK)),
-        "ADD": (commands.add, build_regex("ADD", R_USERNAME, R_PRICE)),
-        "BUY": (commands.buy, build_regex("BUY", R_USERNAME, R_STOCK, R_PRICE)),
-        "COMMIT_BUY": (commands.commit_buy, build_regex("COMMIT_BUY", R_USERNAME)),
-        "CANCEL_BUY": (commands.cancel_buy, build_regex("CANCEL_BUY", R_USERNAME)),
-        "SELL": (commands.sell, build_regex("SELL", R_USERNAME, R_STOCK, R_PRICE)),
-        "COMMIT_SELL": (commands.commit_sell, build_regex("COMMIT_SELL", R_USERNAME)),
-        "CANCEL_SELL": (commands.cancel_sell, build_regex("CANCEL_SELL", R_USERNAME)),
-        "SET_BUY_AMOUNT": (commands.set_buy_amount, build_regex("SET_BUY_AMOUNT", R_USERNAME, R_STOCK, R_PRICE)),
-        "CANCEL_SET_BUY": (commands.cancel_set_buy, build_regex("CANCEL_SET_BUY", R_USERNAME, R_STOCK)),
-        "SET_BUY_TRIGGER": (commands.set_buy_trigger, build_regex("SET_BUY_TRIGGER", R_USERNAME, R_STOCK, R_PRICE)),
-        "SET_SELL_AMOUNT": (commands.set_sell_amount, build_regex("SET_SELL_AMOUNT", R_USERNAME, R_STOCK, R_PRICE)),
-        "CANCEL_SET_SELL": (commands.cancel_set_sell, build_regex("CANCEL_SET_SELL", R_USERNAME, R_STOCK)),
-        "SET_SELL_TRIGGER": (commands.set_sell_trigger, build_regex("SET_SELL_TRIGGER", R_USERNAME, R_STOCK, R_PRICE)),
-        "DUMPLOG": (commands.dumplog_user, build_regex("DUMPLOG", R_USERNAME, R_FILENAME)),
-        "DISPLAY_SUMMARY": (commands.display_summary, build_regex("DISPLAY_SUMMARY", R_USERNAME))
+        "QUOTE": commands.quote,
+        "ADD": commands.add,
+        "BUY": commands.buy,
+        "COMMIT_BUY": commands.commit_buy,
+        "CANCEL_BUY": commands.cancel_buy,
+        "SELL": commands.sell,
+        "COMMIT_SELL": commands.commit_sell,
+        "CANCEL_SELL": commands.cancel_sell,
+        "SET_BUY_AMOUNT": commands.set_buy_amount,
+        "CANCEL_SET_BUY": commands.cancel_set_buy,
+        "SET_BUY_TRIGGER": commands.set_buy_trigger,
+        "SET_SELL_AMOUNT": commands.set_sell_amount,
+        "CANCEL_SET_SELL": commands.cancel_set_sell,
+        "SET_SELL_TRIGGER": commands.set_sell_trigger,
+        "DUMPLOG": commands.dumplog_user,
+        "DISPLAY_SUMMARY": commands.display_summary
 }
 
-DUMPLOG_PATTERN = build_regex("DUMPLOG", R_FILENAME)
-
-COMMAND_TYPE_PATTERN = re.compile(r"^\[\d+\] ([A-Z_]+)")
 ERROR_PATTERN = re.compile(r"^\[(\d+)\] ([A-Z_]+),([^ ,]+)")
 
 class Processor:
@@ -82,18 +82,29 @@ class Processor:
         # 'not connectable' state, so execute connection in such a
         # way that it can be repeated.
 
+        if EXECUTOR_SHARDS:
+            # Each executor holds on to a connection, so the pool only needs
+            # one per executor, plus a few for the background tasks.
+            conn_min = conn_max = EXECUTOR_SHARDS + EXECUTOR_RESERVE
+        else:
+            conn_min, conn_max = CONN_MIN, CONN_MAX
+
         success = False
         while not success:
             try:
                 self.pool = loop.run_until_complete(
                         asyncpg.create_pool(
-                            min_size=CONN_MIN,
-                            max_size=CONN_MAX,
+                            min_size=conn_min,
+                            max_size=conn_max,
                             database=DB,
                             user=DB_USER,
                             password=DB_PASSWORD,
                             host=DB_HOST,
-                            port=DB_PORT
+                            port=DB_PORT,
+                            connection_class=statements.StatementConnection,
+                            statement_cache_size=statements.CACHE_SIZE,
+                            max_cached_statement_lifetime=statements.CACHE_LIFETIME,
+                            init=statements.prepare_all
                     )
                 )
                 success = True
@@ -101,9 +112,16 @@ class Processor:
                 # Database is still in a non-connectable state.
                 continue
 
+        self.shards = []
+        for index in range(EXECUTOR_SHARDS):
+            queue = asyncio.Queue(loop=loop)
+            self.shards.append(queue)
+            loop.create_task(self._handle_shard(index, queue))
+
         commands.init(loop)
         loop.create_task(commands.reservation_timeout_handler(self.pool))
         loop.create_task(commands.trigger_maintainer(self.pool, self.publisher))
+        loop.create_task(commands.listener(self.pool))
 
     def _log_error(self, transaction):
 
@@ -132,7 +150,9 @@ class Processor:
                 "type":"errorEvent",
                 "data": data
             }
-            self.publisher.publish_message(json.dumps(message))
+            # This is called from synchronous code, so the publish is
+            # scheduled rather than awaited.
+            asyncio.ensure_future(self.publisher.publish_message(json.dumps(message)))
         except:
             logger.exception("Error logging failed for %s.", transaction)
 
@@ -150,111 +170,162 @@ class Processor:
 
     async def register_transaction(self, transaction, callback=None):
 
-        type_match = re.match(COMMAND_TYPE_PATTERN, transaction)
-        command_type = type_match.groups()[0]
-        logger.debug("Command type %s found.", command_type)
+        command = parser.parse(transaction)
 
-        if not command_type or command_type not in PROCESSORS:
+        if not command:
             self._log_error(transaction)
-            logger.error("Transaction %s did not match any pattern.", transaction)
+            logger.error("Transaction %s is invalid, discarding.", transaction)
             return False
 
-        logger.info("Transaction %s found to be type %s.", transaction, command_type)
-
-        processor, validity_pattern = PROCESSORS[command_type]
-        match = re.match(validity_pattern, transaction)
+        logger.debug("Transaction %s parsed as %s.", transaction, command)
 
-        if not match:
+        if not command.username:
             # There is a special case that we must account for, in that there is a derivation
-            # of DUMPLOG that does not contain a username, and applies to all users. If we
-            # see 'DUMPLOG', we may fail to match on it, as it may not have a username. Here
-            # we check for this special case explicitly.
-
-            dumplog_match = re.match(DUMPLOG_PATTERN, transaction)
-            if not dumplog_match:
-                self._log_error(transaction)
-                logger.debug("Pattern for transaction %s is invalid, discarding.", transaction)
-                return False
-
-            dumplog_groups = dumplog_match.groups()
-
-            # We cannot fall through and use the code below, as it assumes that a specific
-            # user is responsible for the command. Instead, initialize a new task to deal
-            # with this command.
-            asyncio.create_task(self._handle_dumplog(transaction, *dumplog_groups))
+            # of DUMPLOG that does not contain a username, and applies to all users. We cannot
+            # fall through and use the code below, as it assumes that a specific user is
+            # responsible for the command. Instead, initialize a new task to deal with this command.
+            asyncio.create_task(self._handle_dumplog(transaction, command.transaction_num, *command.args))
 
             # Return early as we don't want a specific user to deal with this command.
             return True
-            
 
         # At this point, we have a valid and standard command (with a username)
-        groups = match.groups()
-        logger.info("Pattern %s matched %s.", validity_pattern, groups)
-
-        # Note that we are not expecting the DUMPLOG (with no user) command at the moment,
-        # as it should have been dealt with above and contains no username.
-        username = groups[1]
-        logger.debug("Username %s found for %s.", username, transaction)
+        processor = PROCESSORS[command.command]
+        username = command.username
 
         # If a queue exists for this user then add the transaction
         # to the queue. If one does not, create it and start an
         # async worker to process the queue.
-        queue = None
-        if username in self.users:
-            queue = self.users[username]
-            logger.info("Added user %s to existing queue.", username)
+        #
+        # Nothing is awaited between looking up the queue and adding
+        # the transaction to it. This means that 2 requests for the
+        # same user can never both create a queue, and that an idle
+        # worker can never be reaped while we are adding to its queue.
+        if self.shards:
+            # Every user in this process already has the same hash modulo the
+            # worker count, so hash over all executors of all workers to make
+            # sure that users are still spread over each of ours.
+            executor = shard_for(username, len(self.shards) * WORKER_COUNT) // WORKER_COUNT
+            queue = self.shards[executor]
         else:
+            queue = self.users.get(username)
+
+        if queue is None:
             queue = asyncio.Queue(loop=loop)
             self.users[username] = queue
-            loop.create_task(self._handle_user(queue))
-            logger.info("Created new queue (%s) for user %s.", id(queue), username)
-
-        # There is an implicit race condition here that may occur if
-        # 2 requests for the same user attempt to create a queue at
-        # the same time. This would result in 2 queues, and 2 async
-        # workers, only 1 of which would receive the remainder of
-        # the requests. In practice this is not a problem, however
-        # it may be possible that the first 2 requests for a user
-        # are not in the correct order, providing this rare race
-        # condition rears its head.
+            loop.create_task(self._handle_user(username, queue))
+            logger.info("Created new queue (%s) for user %s, %s live workers.",
+                    id(queue), username, len(self.users))
 
         # Set up the processing function for running asynchronously.
-        work = lambda settings: processor(*groups, **settings)
-        await queue.put((work, transaction, callback))
+        work = lambda settings: processor(command.transaction_num, username, *command.args, **settings)
+        queue.put_nowait((username, work, transaction, callback))
         logger.debug("Transaction %s added to queue.", transaction)
 
         return True
 
-    async def _handle_user(self, queue):
-        # In theory creating a new async worker for each user
-        # is not great, as they will never go away. In practice
-        # this is fine for the scope of the project, as they
-        # are not scheduled if they are not active, and our
-        # limitation becomes the memory that they allocate in
-        # a real system. With the amount of users that we are
-        # dealing with, this won't be an issue.
+    async def _handle_user(self, username, queue):
+        # Each active user has their own async worker, so that their
+        # commands are processed in order. A worker exits once its user
+        # has been idle for USER_IDLE_TIMEOUT seconds, so memory use is
+        # proportional to the number of active users rather than to the
+        # number of users ever seen. What is kept in memory about the user
+        # lives as long as their worker.
+        state = UserState(username)
 
         while True:
-            work_item, transaction, callback = await queue.get()
+            try:
+                _, work_item, transaction, callback = await asyncio.wait_for(
+                        queue.get(), USER_IDLE_TIMEOUT, loop=loop)
+            except asyncio.TimeoutError:
+                # A transaction may have been added as the timeout fired,
+                # in which case it is left in the queue for us to process.
+                if not queue.empty():
+                    continue
+
+                del self.users[username]
+                logger.info("Reaped idle worker for user %s, %s live workers.",
+                        username, len(self.users))
+                return
+
             logger.info("Work retreived for transaction %s.", transaction)
 
-            async with self.pool.acquire() as conn:
-                arguments = {
-                        "conn": conn,
-                        "publisher": self.publisher
-                }
-
-                try:
-                    result = await work_item(arguments)
-                    if callback:
-                        await callback(result)
-
-                    logger.info("Work item completed for transaction %s.", transaction)
-                except:
-                    # We log the error (in xml) and continue to limp along, hoping the
-                    # issue doesn't occur again. If it does, there's not much we can do.
-                    logger.exception("Work item failed for transaction %s.", transaction)
-                    self._log_error(transaction)
+            # Commands acquire a connection from the pool themselves, and only
+            # for as long as they need it, so none is held here.
+            arguments = {
+                    "pool": self.pool,
+                    "publisher": self.publisher,
+                    "state": state
+            }
+            await self._run_work(work_item, transaction, callback, arguments)
+
+    async def _handle_shard(self, index, queue):
+        # Each executor processes the commands of every user that hashes to
+        # it, in order, so the per user ordering is kept. The executor owns
+        # its connection for as long as it lives, and only gets a new one
+        # if that connection is lost. It also keeps what is held in memory
+        # about each of its users, until they have been idle for
+        # USER_IDLE_TIMEOUT seconds, as a user's own worker would. The states
+        # are kept in the order they were last used, with the time of that use.
+        states = OrderedDict()
+
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    logger.info("Executor %s acquired its connection.", index)
+
+                    while not conn.is_closed():
+                        username, work_item, transaction, callback = await queue.get()
+                        logger.info("Work retreived for transaction %s by executor %s.", transaction, index)
+
+                        now = loop.time()
+                        state, _ = states.pop(username, (None, None))
+                        if not state:
+                            state = UserState(username)
+                        states[username] = (state, now)
+
+                        while next(iter(states.values()))[1] < now - USER_IDLE_TIMEOUT:
+                            idle, _ = states.popitem(last=False)
+                            logger.info("Executor %s dropped idle user %s.", index, idle)
+
+                        arguments = {
+                                "conn": conn,
+                                "pool": self.pool,
+                                "publisher": self.publisher,
+                                "state": state
+                        }
+                        await self._run_work(work_item, transaction, callback, arguments)
+            except Exception:
+                logger.exception("Executor %s lost its connection.", index)
+                await asyncio.sleep(1)
+
+    async def _run_work(self, work_item, transaction, callback, arguments):
+        try:
+            result = await work_item(arguments)
+            if callback:
+                await callback(result)
+
+            logger.info("Work item completed for transaction %s.", transaction)
+        except:
+            # We log the error (in xml) and continue to limp along, hoping the
+            # issue doesn't occur again. If it does, there's not much we can do.
+            logger.exception("Work item failed for transaction %s.", transaction)
+            self._log_error(transaction)
+
+            # The command may have failed after its change was written to the
+            # database but before it was made in memory, so what is held about
+            # the user is loaded again from the database before it is used.
+            arguments["state"].forget()
+
+        state = arguments["state"]
+        if not state.owned:
+            # The user's own worker is unavailable, so it has to be told that
+            # their account may have changed here.
+            try:
+                await commands.account_changed(state.username, **arguments)
+            except:
+                logger.exception("Telling the worker of %s about transaction %s failed.",
+                        state.username, transaction)
                 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -282,12 +353,31 @@ async def root():
     response = jsonify(success=True)
     return response
 
-transaction_num = 0
+@app.route('/batch', methods=['POST'])
+async def batch():
+
+    body = await request.data
+    lines = [line for line in body.decode().splitlines() if line.strip()]
+    logger.info("Batch received with %s transactions.", len(lines))
+
+    # Registering only queues each transaction up, so doing it in order
+    # keeps the order of every user's transactions within the batch.
+    results = []
+    for transaction in lines:
+        registered = await processor.register_transaction(transaction)
+        results.append(registered)
+
+    return jsonify(results=results)
+
+# The number of the last /api transaction. Behind the launcher, each worker
+# gives out every WORKER_COUNT'th number, starting from its own index, so that
+# no 2 workers log transactions under the same number.
+transaction_num = WORKER_INDEX + 1 - WORKER_COUNT
 
 @app.route('/api', methods=['POST'])
 async def api():
     global transaction_num
-    transaction_num += 1
+    transaction_num += WORKER_COUNT
     trans_copy = transaction_num
     
     body = await request.data
@@ -301,8 +391,8 @@ async def api():
         "error": None
     }
 
-    quote_pattern = PROCESSORS["QUOTE"][1]
-    if re.match(quote_pattern, transaction):
+    command = parser.parse(transaction)
+    if command and command.command == "QUOTE":
         async def callback(result):
             price = result[0]
             stock = result[1]
@@ -345,6 +435,20 @@ async def api():
     
     return jsonify(result_dict)
 
+@app.route('/health', methods=['GET'])
+async def health():
+    return jsonify(success=True)
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    info = {
+        "live_workers": len(processor.users),
+        "executor_shards": len(processor.shards),
+        "statements": statements.stats,
+        "trigger_sweep": commands.sweep_stats
+    }
+    return jsonify(info)
+
 @app.route('/status', methods=['POST'])
 async def status():
 
@@ -432,4 +536,4 @@ async def status():
     return jsonify(info)
 
 
-app.run(host="0.0.0.0", port="5000", loop=loop)
+app.run(host="0.0.0.0", port=PORT, loop=loop)
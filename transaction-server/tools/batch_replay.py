@@ -0,0 +1,43 @@
+"""
+Replays a workload file through the /batch endpoint, sending it in chunks
+rather than one request per transaction, and reports any rejected lines.
+
+Usage: python batch_replay.py WORKLOAD [--url URL] [--size SIZE]
+"""
+
+import argparse
+import json
+import time
+import urllib.request
+
+def post(url, lines):
+    body = "\n".join(lines).encode()
+    request = urllib.request.Request(url, data=body, method="POST")
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode())["results"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("workload")
+    parser.add_argument("--url", default="http://localhost:4000/batch")
+    parser.add_argument("--size", type=int, default=10000,
+            help="transactions sent per request")
+    args = parser.parse_args()
+
+    with open(args.workload) as workload:
+        lines = [line.rstrip("\r\n") for line in workload if line.strip()]
+
+    start = time.monotonic()
+    rejected = 0
+    for offset in range(0, len(lines), args.size):
+        chunk = lines[offset:offset + args.size]
+        for line, accepted in zip(chunk, post(args.url, chunk)):
+            if not accepted:
+                rejected += 1
+                print("Rejected: {}".format(line))
+
+    elapsed = time.monotonic() - start
+    print("Sent {} transactions in {:.2f}s, {} rejected.".format(len(lines), elapsed, rejected))
+
+if __name__ == "__main__":
+    main()
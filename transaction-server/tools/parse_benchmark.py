@@ -0,0 +1,110 @@
+"""
+Benchmark the single pass transaction parser in lib/parser.py against the
+regex chain that register_transaction previously used, over a workload file.
+
+Every line is parsed by both, and their results are compared before timing.
+
+Usage: python parse_benchmark.py [workload] [--rounds N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import lib.parser as parser
+
+DEFAULT_WORKLOAD = os.path.join(HERE, "..", "..", "workloads", "100-user-workload")
+
+# The previous regex chain, as it was in server.py.
+
+R_START = r"^"
+R_TRANS_NUM = r"^\[(\d+)\] "
+R_END = r" ?$"
+def build_regex(*args):
+    center = ",".join(args)
+    return re.compile(R_START + R_TRANS_NUM + center + R_END)
+
+R_STOCK = r"([A-Z]{1,3})"
+R_PRICE = r"(\d+\.\d{2})"
+R_USERNAME = r"([^ ]+)"
+R_FILENAME = r"([\w\-. /]+)"
+
+PATTERNS = {
+        "QUOTE": build_regex("QUOTE", R_USERNAME, R_STOCK),
+        "ADD": build_regex("ADD", R_USERNAME, R_PRICE),
+        "BUY": build_regex("BUY", R_USERNAME, R_STOCK, R_PRICE),
+        "COMMIT_BUY": build_regex("COMMIT_BUY", R_USERNAME),
+        "CANCEL_BUY": build_regex("CANCEL_BUY", R_USERNAME),
+        "SELL": build_regex("SELL", R_USERNAME, R_STOCK, R_PRICE),
+        "COMMIT_SELL": build_regex("COMMIT_SELL", R_USERNAME),
+        "CANCEL_SELL": build_regex("CANCEL_SELL", R_USERNAME),
+        "SET_BUY_AMOUNT": build_regex("SET_BUY_AMOUNT", R_USERNAME, R_STOCK, R_PRICE),
+        "CANCEL_SET_BUY": build_regex("CANCEL_SET_BUY", R_USERNAME, R_STOCK),
+        "SET_BUY_TRIGGER": build_regex("SET_BUY_TRIGGER", R_USERNAME, R_STOCK, R_PRICE),
+        "SET_SELL_AMOUNT": build_regex("SET_SELL_AMOUNT", R_USERNAME, R_STOCK, R_PRICE),
+        "CANCEL_SET_SELL": build_regex("CANCEL_SET_SELL", R_USERNAME, R_STOCK),
+        "SET_SELL_TRIGGER": build_regex("SET_SELL_TRIGGER", R_USERNAME, R_STOCK, R_PRICE),
+        "DUMPLOG": build_regex("DUMPLOG", R_USERNAME, R_FILENAME),
+        "DISPLAY_SUMMARY": build_regex("DISPLAY_SUMMARY", R_USERNAME)
+}
+
+DUMPLOG_PATTERN = build_regex("DUMPLOG", R_FILENAME)
+COMMAND_TYPE_PATTERN = re.compile(r"^\[\d+\] ([A-Z_]+)")
+
+def legacy(transaction):
+    type_match = re.match(COMMAND_TYPE_PATTERN, transaction)
+    if not type_match:
+        return None
+
+    command_type = type_match.groups()[0]
+    if command_type not in PATTERNS:
+        return None
+
+    match = re.match(PATTERNS[command_type], transaction)
+    if not match:
+        dumplog_match = re.match(DUMPLOG_PATTERN, transaction)
+        if not dumplog_match:
+            return None
+
+        number, filename = dumplog_match.groups()
+        return parser.Command(int(number), "DUMPLOG", None, (filename,))
+
+    groups = match.groups()
+    return parser.Command(int(groups[0]), command_type, groups[1], groups[2:])
+
+def measure(parse, transactions, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for transaction in transactions:
+            parse(transaction)
+    return time.perf_counter() - start
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Transaction parser benchmark.")
+    argument_parser.add_argument("workload", nargs="?", default=DEFAULT_WORKLOAD)
+    argument_parser.add_argument("--rounds", type=int, default=5)
+    args = argument_parser.parse_args()
+
+    # The workload generator sends each line without its line ending.
+    with open(args.workload) as f:
+        transactions = [line.rstrip("\r\n") for line in f]
+
+    mismatches = sum(1 for t in transactions if legacy(t) != parser.parse(t))
+    print("Result mismatches: {}".format(mismatches))
+
+    total = len(transactions) * args.rounds
+    legacy_time = measure(legacy, transactions, args.rounds)
+    parser_time = measure(parser.parse, transactions, args.rounds)
+
+    print("Transactions:    {}".format(total))
+    print("regex chain:     {:.2f}s ({:.0f} transactions/s)".format(legacy_time, total / legacy_time))
+    print("single pass:     {:.2f}s ({:.0f} transactions/s)".format(parser_time, total / parser_time))
+    print("Speedup:         {:.1f}x".format(legacy_time / parser_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+A stand-in for the course quote server, for running the transaction server
+without access to quoteserve.seng.uvic.ca. Unlike the real server, connections
+are kept open so that they can be reused by the transaction server's pool.
+
+Usage: python stub_quote_server.py [--host HOST] [--port PORT] [--close]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+def build_response(request):
+    """Build a response in the same format as the real quote server."""
+
+    symbol, username = request.split(",", 1)
+    price = random.uniform(1, 500)
+    timestamp = int(time.time() * 1000)
+    seed = "{},{},{}".format(symbol, username, timestamp).encode("ascii")
+    cryptokey = hashlib.sha1(seed).hexdigest()
+
+    return "{:.2f},{},{},{},{}\n".format(price, symbol, username, timestamp, cryptokey)
+
+async def handle(reader, writer, close):
+    peer = writer.get_extra_info("peername")
+    logger.info("Connection opened from %s.", peer)
+
+    buffered = ""
+    while True:
+        raw = await reader.read(1024)
+        if not raw:
+            break
+
+        # Requests are terminated by a carriage return, but be lenient
+        # and also accept new lines.
+        buffered += raw.decode("ascii").replace("\n", "\r")
+        *requests, buffered = buffered.split("\r")
+
+        for request in requests:
+            if not request:
+                continue
+
+            response = build_response(request.strip())
+            logger.debug("Responding to '%s' with '%s'.", request, response.strip())
+            writer.write(response.encode("ascii"))
+
+        await writer.drain()
+
+        if close:
+            # Mimic the real quote server, which only
+            # serves one request per connection.
+            break
+
+    logger.info("Connection closed from %s.", peer)
+    writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub quote server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4444)
+    parser.add_argument("--close", action="store_true",
+            help="close each connection after one response, like the real server")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    loop = asyncio.get_event_loop()
+    handler = lambda reader, writer: handle(reader, writer, args.close)
+    server = loop.run_until_complete(asyncio.start_server(handler, args.host, args.port, loop=loop))
+    logger.info("Stub quote server listening on %s:%s.", args.host, args.port)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,6 @@ import java.util.ArrayList;
 import java.util.Iterator;
 import java.util.LinkedList;
 import java.util.List;
-import java.util.Map;
-import java.util.LinkedHashMap;
 import java.util.concurrent.Future;
 
 
@@ -22,20 +20,9 @@ public class Generator {
     private static final int NS_IN_MS = 1_000_000;
     private static final int MS_IN_S = 1_000;
 
-    //private static final String HOSTNAME = "transaction-server";
-    private static final int PORT = 4000;
-
-    private static final String[] ADDRESSES = new String[]{
-    	"192.168.1.249",
-    	"192.168.1.177",
-    	"192.168.1.196",
-    	"192.168.1.207",
-    	"192.168.1.200",
-    	"192.168.1.164"
-    };
-
-    private static final String URL_PRE = "http://";
-    private static final String URL_POST = ":" + PORT;
+    // The router spreads users between the transaction server nodes, so
+    // every request is sent to it. Override with the ROUTER_URL variable.
+    private static final String DEFAULT_URL = "http://router:5000";
 
     public static void main(String args[]) {
 
@@ -80,31 +67,14 @@ public class Generator {
         final int numRequests = lines.size();
         final Request[] requests = new Request[numRequests - 1];
 
-	final int servers = ADDRESSES.length;
-	final Map<String, String> lookup = new LinkedHashMap<>();
-	int index = 0;
+	final String url = System.getenv().getOrDefault("ROUTER_URL", DEFAULT_URL);
 	int i;
 
         final AsyncHttpClient client = Dsl.asyncHttpClient();
 
         for (i = 0; i < numRequests; i++) {
 	    final String body = iterator.next();
-	    final String username = body
-		    .split(",")[1]
-		    .replace("\n", "")
-		    .replace("\r", "")
-		    .replace(" ", "");
-
-	    final String host;
-	    if (lookup.containsKey(username)) {
-		host = lookup.get(username);
-	    } else {
-		host = ADDRESSES[index];
-		index = (index + 1) % ADDRESSES.length;
-		lookup.put(username, host);
-	    }
-
-            Request request = Dsl.post(URL_PRE + host + URL_POST)
+            Request request = Dsl.post(url)
                     .setBody(body)
                     .build();
 	    